@@ -135,6 +135,8 @@ for i,idx in enumerate(test_im_idx):
 
 np.save('processed_data/subj{:02d}/nsd_test_fmriavg_nsdgeneral_sub{}.npy'.format(sub,sub),fmri_array )
 np.save('processed_data/subj{:02d}/nsd_test_stim_sub{}.npy'.format(sub,sub),stim_array )
+# NSD ids of the test images, a cheap key to tell whether two subjects share their test features
+np.save('processed_data/subj{:02d}/nsd_test_stimidx_sub{}.npy'.format(sub,sub),np.array(test_im_idx) )
 
 print("Test data is saved.")
 
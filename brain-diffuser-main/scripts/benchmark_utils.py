@@ -0,0 +1,51 @@
+import os
+import time
+import resource
+import torch
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def measure(fn, reps, device, warmup=1):
+    """
+    Mean latency of fn in ms over reps calls, after warmup calls (compiled
+    and scripted modules optimise on their first calls).
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn()
+        synchronize(device)
+        start = time.perf_counter()
+        for _ in range(reps):
+            fn()
+        synchronize(device)
+    return (time.perf_counter() - start) / reps * 1e3
+
+
+def peak_memory(fn, device):
+    """
+    Peak memory in MB allocated while running fn: the CUDA allocator peak,
+    or on CPU the growth of the peak RSS of a forked child running fn.
+    """
+    if device.type == 'cuda':
+        synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        with torch.no_grad():
+            fn()
+        synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - base) / 2**20
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # ru_maxrss is in KB on Linux
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        with torch.no_grad():
+            fn()
+        os.write(write, str(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base).encode())
+        os._exit(0)
+    os.waitpid(pid, 0)
+    return int(os.read(read, 64)) / 2**10
@@ -9,6 +9,7 @@ from lib.model_zoo import get_model
 from torch.utils.data import DataLoader, Dataset
 
 from lib.model_zoo.vd import VD
+from lib.model_zoo.vd_checkpoint import load_vd_model
 from lib.cfg_holder import cfg_unique_holder as cfguh
 from lib.cfg_helper import get_command_line_args, cfg_initiates, load_cfg_yaml
 import matplotlib.pyplot as plt
@@ -21,12 +22,10 @@ args = parser.parse_args()
 sub=int(args.sub)
 assert sub in [1,2,5,7]
 
-cfgm_name = 'vd_noema'
+cfgm_name = 'vd_noema_clip'
 pth = 'versatile_diffusion/pretrained/vd-four-flow-v1-0-fp16-deprecated.pth'
 cfgm = model_cfg_bank()(cfgm_name)
-net = get_model()(cfgm)
-sd = torch.load(pth, map_location='cpu')
-net.load_state_dict(sd, strict=False)    
+net = load_vd_model(cfgm, pth)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 net.clip = net.clip.to(device)
@@ -0,0 +1,20 @@
+import os
+from regression_utils import convert_legacy_weights, regression_weights_path
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-sub", "--sub",help="Subject Number",default=1)
+parser.add_argument("-wdtype", "--weights_dtype",help="Storage dtype of the regression weights (float32 or float16)",default='float32')
+args = parser.parse_args()
+sub=int(args.sub)
+assert sub in [1,2,5,7]
+
+# Converts the pickled weights of older runs to the memory-mappable format
+for name in ['vdvae', 'cliptext', 'clipvision']:
+    out_dir = regression_weights_path(sub, name)
+    pkl_path = out_dir + '.pkl'
+    if not os.path.exists(pkl_path):
+        print('Skipping {}, {} not found'.format(name, pkl_path))
+        continue
+    convert_legacy_weights(pkl_path, out_dir, weight_dtype=args.weights_dtype)
+    print('Converted {} to {}'.format(pkl_path, out_dir))
@@ -0,0 +1,23 @@
+import sys
+sys.path.append('versatile_diffusion')
+from lib.cfg_helper import model_cfg_bank
+from lib.model_zoo import get_model
+from lib.model_zoo.vd_checkpoint import sharded_checkpoint_path, save_sharded_checkpoint
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-pth", "--pth",help="Versatile Diffusion checkpoint",default='versatile_diffusion/pretrained/vd-four-flow-v1-0-fp16-deprecated.pth')
+parser.add_argument("-cfg", "--cfg",help="Model config whose weights are converted",default='vd_noema')
+parser.add_argument("-dtype", "--dtype",help="Storage dtype of the autokl and diffusion weights (float16 or float32), CLIP is kept in float32",default='float16')
+args = parser.parse_args()
+assert args.dtype in ['float16', 'float32']
+
+# The full model is built once so the shards also hold the autokl, optimus
+# and CLIP weights that building it reads from their own files; scripts
+# then map the shards of the components they use (see load_vd_model)
+net = get_model()(model_cfg_bank()(args.cfg))
+net.set_precision(args.dtype)
+net.load_checkpoint(args.pth)
+out_dir = sharded_checkpoint_path(args.pth)
+save_sharded_checkpoint(net.state_dict(), out_dir)
+print('Converted {} to {}'.format(args.pth, out_dir))
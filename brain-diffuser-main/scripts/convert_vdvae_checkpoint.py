@@ -0,0 +1,16 @@
+import sys
+sys.path.append('vdvae')
+import torch
+from vae_inference import inference_checkpoint_path, save_inference_checkpoint
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-ckpt", "--ckpt",help="EMA checkpoint of the VDVAE",default='vdvae/model/imagenet64-iter-1600000-model-ema.th')
+parser.add_argument("-dtype", "--dtype",help="Storage dtype of the weights (float32 or float16)",default='float32')
+args = parser.parse_args()
+
+# Only the EMA weights are used for inference; they are stored in a
+# memory-mappable format that load_vaes picks up next to the checkpoint
+out_dir = inference_checkpoint_path(args.ckpt)
+save_inference_checkpoint(torch.load(args.ckpt, map_location='cpu'), out_dir, dtype=args.dtype)
+print('Converted {} to {}'.format(args.ckpt, out_dir))
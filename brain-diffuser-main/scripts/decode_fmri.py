@@ -0,0 +1,30 @@
+import numpy as np
+from regression_utils import FmriDecoder, regression_weights_path, VDVAE_LAYERS
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-sub", "--sub",help="Subject Number",default=1)
+parser.add_argument("-feat", "--feat",help="Feature space (vdvae, cliptext or clipvision)",default='vdvae')
+parser.add_argument("-input", "--input",help="Raw fMRI samples (n, voxels) in nsdgeneral space as .npy",required=True)
+parser.add_argument("-output", "--output",help="Where to save the decoded features",required=True)
+parser.add_argument("-bs", "--bs",help="Mini-batch size of the incoming scans",default=1)
+parser.add_argument("-update_stats", "--update_stats",help="Domain adaptation: update the prediction statistics with each mini-batch instead of keeping the fitted ones",action='store_true')
+parser.add_argument("-layers", "--layers",help="Number of regressed VDVAE latent layers",default=VDVAE_LAYERS)
+args = parser.parse_args()
+sub=int(args.sub)
+assert sub in [1,2,5,7]
+assert args.feat in ['vdvae','cliptext','clipvision']
+batch_size=int(args.bs)
+
+decoder = FmriDecoder.load(regression_weights_path(sub,args.feat,int(args.layers)))
+fmri = np.load(args.input, mmap_mode='r')
+
+# Scans are decoded as they arrive, mini-batch by mini-batch
+pred = np.zeros((len(fmri),)+decoder.weights.feature_shape).astype(np.float32)
+num_batches = (len(fmri) + batch_size - 1) // batch_size
+for b, i in enumerate(range(0, len(fmri), batch_size)):
+    pred[i:i+batch_size] = decoder.predict(fmri[i:i+batch_size], update_stats=args.update_stats)
+    if (b + 1) % 100 == 0 or b + 1 == num_batches:
+        print('batch {}/{}'.format(b + 1, num_batches))
+
+np.save(args.output, pred)
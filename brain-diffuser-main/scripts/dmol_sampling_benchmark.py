@@ -0,0 +1,37 @@
+import sys
+sys.path.append('vdvae')
+import torch
+import numpy as np
+from benchmark_utils import measure, peak_memory
+from vae_helpers import sample_from_discretized_mix_logistic, mean_from_discretized_mix_logistic
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-bs", "--bs",help="Batch Size",default=30)
+parser.add_argument("-size", "--size",help="Image size",default=64)
+parser.add_argument("-mix", "--mix",help="Number of logistic mixtures",default=10)
+parser.add_argument("-reps", "--reps",help="Timed repetitions",default=20)
+parser.add_argument("-device", "--device",help="Device to benchmark on",default='cuda' if torch.cuda.is_available() else 'cpu')
+args = parser.parse_args()
+batch_size, size, nr_mix, reps = int(args.bs), int(args.size), int(args.mix), int(args.reps)
+device = torch.device(args.device)
+
+# DmolNet output for a batch of images, (n, h, w, 10 * nr_mix)
+torch.manual_seed(0)
+l = torch.randn(batch_size, size, size, 10 * nr_mix, device=device)
+
+
+to_uint8 = lambda im: ((im + 1.0) * 127.5).clamp(0.0, 255.0).to(torch.uint8).cpu().numpy().astype(np.int16)
+
+with torch.no_grad():
+    sampled = sample_from_discretized_mix_logistic(l, nr_mix)
+    mean = mean_from_discretized_mix_logistic(l, nr_mix)
+sample_ms = measure(lambda: sample_from_discretized_mix_logistic(l, nr_mix), reps, device)
+mean_ms = measure(lambda: mean_from_discretized_mix_logistic(l, nr_mix), reps, device)
+sample_peak = peak_memory(lambda: sample_from_discretized_mix_logistic(l, nr_mix), device)
+mean_peak = peak_memory(lambda: mean_from_discretized_mix_logistic(l, nr_mix), device)
+print('{} images of {}x{} with {} mixtures on {}'.format(batch_size, size, size, nr_mix, device))
+print('sample  {:8.2f}ms  peak {:.1f}MB'.format(sample_ms, sample_peak))
+print('mean    {:8.2f}ms  peak {:.1f}MB  ({:.1f}x faster)'.format(mean_ms, mean_peak, sample_ms / mean_ms))
+print('mean abs difference between the sampled and mean images {:.2f} levels'.format(
+    np.abs(to_uint8(sampled) - to_uint8(mean)).mean()))
@@ -0,0 +1,98 @@
+import os
+import threading
+import numpy as np
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
+from regression_utils import train_decoder, load_fmri, load_features, load_test_stimulus_index, FEATURE_SPACES
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-subs", "--subs",help="Comma separated subject numbers",default='1,2,5,7')
+parser.add_argument("-feats", "--feats",help="Comma separated feature spaces",default='vdvae,cliptext,clipvision')
+parser.add_argument("-n_jobs", "--n_jobs",help="Number of regressions fitted concurrently (0 for one per fit, up to the number of cores)",default=0)
+parser.add_argument("-wdtype", "--weights_dtype",help="Storage dtype of the regression weights (float32 or float16)",default='float32')
+parser.add_argument("-vox_pca", "--vox_pca",help="Number of fMRI PCA components to regress from (0 uses all voxels)",default=0)
+parser.add_argument("-rank", "--rank",help="Rank of the reduced-rank CLIP regressions (0 regresses each token separately)",default=0)
+parser.add_argument("-dtype", "--dtype",help="Precision of normalisation, ridge solve and prediction (float64 or float32)",default='float64')
+args = parser.parse_args()
+subs = [int(s) for s in args.subs.split(',')]
+feats = args.feats.split(',')
+assert all(sub in [1,2,5,7] for sub in subs)
+assert all(feat in FEATURE_SPACES for feat in feats)
+assert args.dtype in ['float64','float32']
+
+jobs = [(sub, feat) for sub in subs for feat in feats]
+num_cores = os.cpu_count() or 1
+n_jobs = int(args.n_jobs) or min(len(jobs), num_cores)
+# Fits run in threads of one process and share the cores, BLAS gets the rest
+blas_threads = max(1, num_cores // n_jobs)
+
+
+class SharedTestFeatures(object):
+    """
+    The test stimuli are the shared NSD images, so their features are kept
+    once per feature space. Other subjects share them when their test
+    stimulus ids, saved by prepare_nsddata.py, match those of the shared
+    copy and only load their own file otherwise. Without the ids the
+    (memory-mapped) file is compared in full with the shared copy.
+    """
+    def __init__(self):
+        self.features = {}
+        self.stimulus_index = {}
+        self.lock = threading.Lock()
+
+    def get(self, sub, name):
+        with self.lock:
+            if name not in self.features:
+                self.features[name] = load_features(sub, name, 'test')
+                self.stimulus_index[name] = load_test_stimulus_index(sub)
+                return self.features[name]
+            shared = self.features[name]
+            shared_index = self.stimulus_index[name]
+        own_index = load_test_stimulus_index(sub)
+        if own_index is not None and shared_index is not None:
+            if np.array_equal(own_index, shared_index):
+                return shared
+            return load_features(sub, name, 'test')
+        own = load_features(sub, name, 'test', mmap_mode='r')
+        if np.array_equal(own, shared):
+            return shared
+        return np.asarray(own)
+
+
+class SubjectFmri(object):
+    """Raw fMRI of each subject, loaded once and shared by its feature spaces."""
+    def __init__(self):
+        self.fmri = {}
+        self.locks = {sub: threading.Lock() for sub in subs}
+
+    def get(self, sub):
+        with self.locks[sub]:
+            if sub not in self.fmri:
+                self.fmri[sub] = load_fmri(sub)
+            return self.fmri[sub]
+
+
+shared_test = SharedTestFeatures()
+subject_fmri = SubjectFmri()
+
+
+def fit(sub, name):
+    def log(*msg):
+        print('[subj{:02d} {}]'.format(sub, name), *msg)
+    log('Loading features')
+    train_decoder(sub, name,
+                  fmri=subject_fmri.get(sub),
+                  train_targets=load_features(sub, name, 'train', mmap_mode='r'),
+                  test_targets=shared_test.get(sub, name),
+                  rank=int(args.rank) if name != 'vdvae' else 0,
+                  n_pca=int(args.vox_pca),
+                  dtype=args.dtype,
+                  weight_dtype=args.weights_dtype,
+                  log=log)
+    log('Done')
+
+
+print('Fitting {} regressions with {} jobs, {} BLAS threads each'.format(len(jobs), n_jobs, blas_threads))
+with threadpool_limits(limits=blas_threads):
+    Parallel(n_jobs=n_jobs, prefer='threads')(delayed(fit)(sub, name) for sub, name in jobs)
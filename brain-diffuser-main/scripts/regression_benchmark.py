@@ -0,0 +1,91 @@
+import json
+import numpy as np
+import torch
+from sklearn.model_selection import KFold
+from benchmark_utils import measure, peak_memory
+from regression_utils import fit_decoder, load_fmri, load_features, make_synthetic_data, group_metrics, FEATURE_SPACES
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-sub", "--sub",help="Subject Number (0 for synthetic data)",default=0)
+parser.add_argument("-feats", "--feats",help="Comma separated feature spaces",default='vdvae,cliptext,clipvision')
+parser.add_argument("-dtypes", "--dtypes",help="Comma separated precisions to benchmark",default='float64,float32')
+parser.add_argument("-folds", "--folds",help="Number of cross-validation folds over the train set",default=3)
+parser.add_argument("-rank", "--rank",help="Rank of the reduced-rank CLIP regressions (0 regresses each token separately)",default=0)
+parser.add_argument("-vox_pca", "--vox_pca",help="Number of fMRI PCA components to regress from (0 uses all voxels)",default=0)
+parser.add_argument("-ntrain", "--ntrain",help="Synthetic samples",default=8859)
+parser.add_argument("-nvox", "--nvox",help="Synthetic voxels",default=15724)
+parser.add_argument("-ntokens", "--ntokens",help="Only use the first n CLIP tokens (0 for all)",default=0)
+parser.add_argument("-out", "--out",help="Optional json file for the full per-group results",default='')
+args = parser.parse_args()
+sub=int(args.sub)
+assert sub in [0,1,2,5,7]
+feats = args.feats.split(',')
+dtypes = args.dtypes.split(',')
+assert all(feat in FEATURE_SPACES for feat in feats)
+assert all(dtype in ['float64','float32'] for dtype in dtypes)
+num_tokens = int(args.ntokens)
+# The regressions run in numpy, peak memory is the RSS growth of a forked child
+device = torch.device('cpu')
+
+# Realistic shapes of the NSD subject 1 data
+synthetic_shapes = {'vdvae': (91168,), 'cliptext': (77,768), 'clipvision': (257,768)}
+
+
+def quiet(*msg):
+    pass
+
+
+def load_data(name):
+    if sub == 0:
+        shape = synthetic_shapes[name]
+        if num_tokens and len(shape) > 1:
+            shape = (num_tokens,) + shape[1:]
+        fmri, train_targets, _ = make_synthetic_data(int(args.ntrain), 0, int(args.nvox), shape)
+        return fmri[0], train_targets
+    train_targets = load_features(sub, name, 'train', mmap_mode='r')
+    if num_tokens and train_targets.ndim == 3:
+        train_targets = train_targets[:, :num_tokens]
+    return load_fmri(sub)[0], np.asarray(train_targets)
+
+
+results = []
+for name in feats:
+    fmri, targets = load_data(name)
+    for dtype in dtypes:
+        folds = KFold(n_splits=int(args.folds), shuffle=True, random_state=0).split(fmri)
+        fit_times, predict_times, fit_peaks, predict_peaks, r2s, corrs = [], [], [], [], [], []
+        for train_idx, val_idx in folds:
+            fitted = []
+            fit = lambda: fitted.append(fit_decoder(
+                (fmri[train_idx], fmri[val_idx]), targets[train_idx], targets[val_idx],
+                name, rank=int(args.rank), n_pca=int(args.vox_pca), dtype=dtype, log=quiet))
+            # A fit is too slow to warm up or repeat, it runs once more in peak_memory's child
+            fit_times.append(measure(fit, 1, device, warmup=0) / 1e3)
+            fit_peaks.append(peak_memory(fit, device))
+            decoder = fitted[-1]
+            val_fmri = np.asarray(fmri[val_idx], dtype=dtype)
+            predict = lambda: decoder.predict_raw(val_fmri)
+            predict_times.append(measure(predict, 1, device) / 1e3)
+            predict_peaks.append(peak_memory(predict, device))
+            r2, corr = group_metrics(targets[val_idx], predict())
+            r2s.append(r2)
+            corrs.append(corr)
+
+        r2, corr = np.mean(r2s, axis=0), np.mean(corrs, axis=0)
+        result = {
+            'feature': name, 'dtype': dtype, 'rank': int(args.rank), 'vox_pca': int(args.vox_pca),
+            'fit_s': float(np.mean(fit_times)), 'predict_s': float(np.mean(predict_times)),
+            'fit_peak_mb': float(np.max(fit_peaks)), 'predict_peak_mb': float(np.max(predict_peaks)),
+            'r2': r2.tolist(), 'corr': corr.tolist(), }
+        results.append(result)
+        print('{:<11} {:<8} fit {:8.2f}s predict {:7.3f}s | peak memory fit {:8.1f}MB predict {:7.1f}MB | '
+              'R2 {:.4f} corr {:.4f}'.format(name, dtype, result['fit_s'], result['predict_s'],
+                                              result['fit_peak_mb'], result['predict_peak_mb'], r2.mean(), corr.mean()))
+        group = 'layer' if name == 'vdvae' else 'token'
+        for i in range(len(r2)):
+            print('    {} {:3d} R2 {:.4f} corr {:.4f}'.format(group, i, r2[i], corr[i]))
+
+if args.out:
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
@@ -0,0 +1,62 @@
+import sys
+import time
+import numpy as np
+from regression_utils import fit_decoder, load_fmri, load_features, make_synthetic_data, r2_scores, FEATURE_SPACES
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-sub", "--sub",help="Subject Number (0 for synthetic data)",default=0)
+parser.add_argument("-feats", "--feats",help="Comma separated feature spaces",default='vdvae,cliptext,clipvision')
+parser.add_argument("-pred_tol", "--pred_tol",help="Max float32/float64 prediction difference, relative to the prediction std",default=1e-3)
+parser.add_argument("-score_tol", "--score_tol",help="Max absolute difference of the test scores",default=1e-4)
+parser.add_argument("-rank", "--rank",help="Rank of the reduced-rank CLIP regressions (0 regresses each token separately)",default=0)
+parser.add_argument("-vox_pca", "--vox_pca",help="Number of fMRI PCA components to regress from (0 uses all voxels)",default=0)
+parser.add_argument("-ntrain", "--ntrain",help="Synthetic train samples",default=2000)
+parser.add_argument("-nvox", "--nvox",help="Synthetic voxels",default=4000)
+args = parser.parse_args()
+sub=int(args.sub)
+assert sub in [0,1,2,5,7]
+feats = args.feats.split(',')
+pred_tol, score_tol = float(args.pred_tol), float(args.score_tol)
+
+# Synthetic feature shapes match the real ones except for the token count
+synthetic_shapes = {'vdvae': (91168,), 'cliptext': (77,768), 'clipvision': (257,768)}
+
+def quiet(*msg):
+    pass
+
+failed = False
+for name in feats:
+    if sub == 0:
+        fmri, train_targets, test_targets = make_synthetic_data(int(args.ntrain), 982, int(args.nvox), synthetic_shapes[name])
+    else:
+        fmri = load_fmri(sub)
+        train_targets = load_features(sub, name, 'train', mmap_mode='r')
+        test_targets = load_features(sub, name, 'test')
+
+    results = {}
+    for dtype in [np.float64, np.float32]:
+        start = time.time()
+        decoder = fit_decoder(fmri, train_targets, test_targets, name, rank=int(args.rank),
+                              n_pca=int(args.vox_pca), dtype=dtype, log=quiet)
+        fit_time = time.time() - start
+        test_fmri = np.asarray(fmri[1], dtype=dtype)
+        raw = decoder.predict_raw(test_fmri)
+        # Weights and predictions must stay in the fit dtype, or the float64 run is no baseline
+        assert decoder.weights.weight.dtype == dtype and raw.dtype == dtype, \
+            'float{} fit produced {} weights and {} predictions'.format(np.dtype(dtype).itemsize*8, decoder.weights.weight.dtype, raw.dtype)
+        pred = decoder.predict(test_fmri, update_stats=True)
+        results[dtype] = (fit_time, raw, pred, r2_scores(np.asarray(test_targets), raw))
+
+    t64, raw64, pred64, score64 = results[np.float64]
+    t32, raw32, pred32, score32 = results[np.float32]
+    raw_err = np.max(np.abs(raw32 - raw64)) / np.std(raw64)
+    pred_err = np.max(np.abs(pred32 - pred64)) / np.std(pred64)
+    score_err = np.max(np.abs(score32 - score64))
+    ok = raw_err <= pred_tol and pred_err <= pred_tol and score_err <= score_tol
+    failed = failed or not ok
+    print('{:<11} fit float64 {:7.1f}s float32 {:7.1f}s | prediction error raw {:.2e} renormalised {:.2e} | '
+          'score float64 {:.4f} float32 {:.4f} max diff {:.2e} | {}'.format(
+              name, t64, t32, raw_err, pred_err, score64.mean(), score32.mean(), score_err, 'OK' if ok else 'FAIL'))
+
+sys.exit(1 if failed else 0)
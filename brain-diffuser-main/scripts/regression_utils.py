@@ -0,0 +1,624 @@
+import os
+import json
+import pickle
+import threading
+import numpy as np
+
+# Regression weights are stored as a directory holding one raw .npy file per
+# array plus a small JSON header, so that the (potentially multi-GB) weight
+# matrices can be memory-mapped instead of unpickled.
+WEIGHTS_HEADER = 'header.json'
+WEIGHTS_FORMAT_VERSION = 1
+# Arrays stored in the requested weight dtype (e.g. float16), everything else
+# (biases, normalisation statistics) is always kept in float32.
+LARGE_ARRAYS = ('weight', 'target_basis')
+# Arrays that define the linear map itself, as opposed to the statistics
+# used to normalise its inputs and outputs.
+WEIGHT_ARRAYS = ('weight', 'bias', 'target_basis', 'voxel_basis')
+
+
+# Flattened size of each VDVAE latent layer (zdim * res**2 for the decoder
+# blocks of the imagenet64 model). The first VDVAE_LAYERS are regressed by
+# default; fewer layers give smaller targets and the remaining layers are
+# sampled from the prior when decoding.
+VDVAE_LAYER_DIMS = [2**4]*2 + [2**8]*4 + [2**10]*8 + [2**12]*16 + [2**14]*32 + [2**16]*13
+VDVAE_LAYERS = 31
+
+
+def vdvae_latent_dims(num_layers=VDVAE_LAYERS):
+    """Length of the flat latents of the first num_layers VDVAE layers."""
+    assert 0 < num_layers <= len(VDVAE_LAYER_DIMS), 'VDVAE has {} latent layers'.format(len(VDVAE_LAYER_DIMS))
+    return sum(VDVAE_LAYER_DIMS[:num_layers])
+
+
+def regression_weights_path(sub, name, num_layers=VDVAE_LAYERS):
+    if name == 'vdvae' and num_layers != VDVAE_LAYERS:
+        name = 'vdvae_{}l'.format(num_layers)
+    return 'data/regression_weights/subj{:02d}/{}_regression_weights'.format(sub, name)
+
+
+def fmri_pca_path(sub, n_components):
+    return 'data/processed_data/subj{:02d}/nsd_train_fmriavg_nsdgeneral_pca{}_sub{}.npy'.format(sub, n_components, sub)
+
+
+def save_regression_weights(out_dir, arrays, header=None, weight_dtype='float32'):
+    """
+    Save regression arrays to out_dir as .npy files together with a JSON header.
+        arrays: dict name -> array, must contain 'weight' and 'bias'
+        header: extra json-serialisable entries (alpha, fmri_scale, ...)
+        weight_dtype: dtype of the large arrays, 'float32' or 'float16'
+    """
+    assert 'weight' in arrays and 'bias' in arrays
+    weight_dtype = np.dtype(weight_dtype)
+    assert weight_dtype in (np.float16, np.float32), \
+        'Unsupported weight dtype {}'.format(weight_dtype)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    info = {}
+    for name, arr in arrays.items():
+        if arr is None:
+            continue
+        dtype = weight_dtype if name in LARGE_ARRAYS else np.float32
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+        np.save(os.path.join(out_dir, name + '.npy'), arr)
+        info[name] = {'shape': list(arr.shape), 'dtype': arr.dtype.name}
+
+    full_header = {
+        'format_version': WEIGHTS_FORMAT_VERSION,
+        'arrays': info,
+    }
+    full_header.update(header or {})
+    with open(os.path.join(out_dir, WEIGHTS_HEADER), 'w') as f:
+        json.dump(full_header, f, indent=2)
+
+
+class RegressionWeights(object):
+    """
+    Lazily loaded regression weights. Arrays are memory-mapped on first
+    access, so reading a single token of the CLIP weights only touches
+    that slice of the file.
+
+    Reduced-rank weights additionally hold a 'target_basis' (rank, features)
+    and 'weight' is then (rank, voxels); the full weights are
+    target_basis.T @ weight and are only formed on demand.
+
+    Weights fitted on PCA-reduced fMRI hold a 'voxel_basis' (voxels,
+    components) and 'weight' acts on the components; weight @ voxel_basis.T
+    maps them back to voxel space.
+    """
+    def __init__(self, path, mmap_mode='r'):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        with open(os.path.join(path, WEIGHTS_HEADER), 'r') as f:
+            self.header = json.load(f)
+        self._arrays = {}
+
+    @classmethod
+    def from_arrays(cls, arrays, header=None, path=None):
+        weights = cls.__new__(cls)
+        weights.path = path
+        weights.mmap_mode = None
+        weights._arrays = {k: np.asarray(v) for k, v in arrays.items() if v is not None}
+        weights.header = {
+            'format_version': WEIGHTS_FORMAT_VERSION,
+            'arrays': {k: {'shape': list(v.shape), 'dtype': v.dtype.name}
+                       for k, v in weights._arrays.items()}, }
+        weights.header.update(header or {})
+        return weights
+
+    @classmethod
+    def from_pickle(cls, pkl_path):
+        # Legacy format written by the regression scripts as a pickled dict
+        with open(pkl_path, 'rb') as f:
+            datadict = pickle.load(f)
+        weights = cls.from_arrays(datadict, path=pkl_path)
+        weights.header['format_version'] = 0
+        return weights
+
+    def save(self, out_dir, weight_dtype='float32'):
+        arrays = {k: self[k] for k in self.header['arrays']}
+        header = {k: v for k, v in self.header.items() if k not in ('format_version', 'arrays')}
+        save_regression_weights(out_dir, arrays, header=header, weight_dtype=weight_dtype)
+
+    def __contains__(self, name):
+        return name in self.header['arrays']
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            if name not in self:
+                raise KeyError(name)
+            self._arrays[name] = np.load(
+                os.path.join(self.path, name + '.npy'), mmap_mode=self.mmap_mode)
+        return self._arrays[name]
+
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+
+    @property
+    def weight(self):
+        return self['weight']
+
+    @property
+    def bias(self):
+        return self['bias']
+
+    @property
+    def alpha(self):
+        return self.header.get('alpha')
+
+    @property
+    def num_voxels(self):
+        if 'voxel_basis' in self:
+            return self['voxel_basis'].shape[0]
+        return self.weight.shape[-1]
+
+    @property
+    def feature_shape(self):
+        return tuple(self.bias.shape)
+
+    @property
+    def rank(self):
+        return self['target_basis'].shape[0] if 'target_basis' in self else None
+
+    def token(self, i, dtype=np.float32):
+        """Voxel-space weights of the i-th output token as a (dim, voxels) array."""
+        if self.rank is None:
+            w = np.asarray(self.weight[i], dtype=dtype)
+        else:
+            basis = self['target_basis'].reshape((self.rank,) + self.feature_shape)[:, i]
+            out_shape = basis.shape[1:]
+            basis = np.asarray(basis, dtype=dtype).reshape(self.rank, -1)
+            w = (basis.T @ np.asarray(self.weight, dtype=dtype)).reshape(out_shape + (-1,))
+        if 'voxel_basis' in self:
+            w = w @ np.asarray(self['voxel_basis'], dtype=dtype).T
+        return w
+
+    def full_weight(self, dtype=np.float32):
+        """Voxel-space weights as a (*feature_shape, voxels) array."""
+        return self.token(slice(None), dtype=dtype)
+
+    def project(self, x, chunk_rows=4096, dtype=None):
+        """
+        Computes x @ W.T without materialising W in memory, reading the
+        memory-mapped weights chunk_rows output rows at a time. The bias
+        is not added. Returns an array of shape (len(x), *feature_shape).
+        """
+        if dtype is None:
+            dtype = np.result_type(self.weight.dtype, np.float32)
+        x = np.asarray(x, dtype=dtype)
+        if 'voxel_basis' in self:
+            x = x @ np.asarray(self['voxel_basis'], dtype=dtype)
+        if self.rank is not None:
+            x = x @ np.asarray(self.weight, dtype=dtype).T
+            w = self['target_basis'].T
+        else:
+            w = self.weight.reshape(-1, self.weight.shape[-1])
+        out = np.empty((len(x), w.shape[0]), dtype=dtype)
+        for s in range(0, w.shape[0], chunk_rows):
+            out[:, s:s+chunk_rows] = x @ np.asarray(w[s:s+chunk_rows], dtype=dtype).T
+        return out.reshape((len(x),) + self.feature_shape)
+
+
+def load_regression_weights(path, mmap_mode='r'):
+    """Loads a weights directory, falling back to the legacy '<path>.pkl'."""
+    if os.path.isdir(path):
+        return RegressionWeights(path, mmap_mode=mmap_mode)
+    pkl_path = path if path.endswith('.pkl') else path + '.pkl'
+    if os.path.exists(pkl_path):
+        return RegressionWeights.from_pickle(pkl_path)
+    raise FileNotFoundError('No regression weights found at {}'.format(path))
+
+
+def convert_legacy_weights(pkl_path, out_dir, weight_dtype='float32', **header):
+    weights = RegressionWeights.from_pickle(pkl_path)
+    weights.header.update(header)
+    weights.save(out_dir, weight_dtype=weight_dtype)
+
+
+class RunningStats(object):
+    """
+    Running mean and (ddof=0) standard deviation over the first axis,
+    merged batch by batch with the parallel update of Chan et al.
+    """
+    def __init__(self, count=0, mean=None, std=None):
+        self.count = int(count)
+        self.mean = None if mean is None else np.array(mean, dtype=np.float64)
+        self.m2 = None if std is None else np.array(std, dtype=np.float64)**2 * self.count
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        n = len(x)
+        if n == 0:
+            return self
+        batch_mean = x.mean(axis=0)
+        batch_m2 = ((x - batch_mean)**2).sum(axis=0)
+        if self.count == 0:
+            self.mean, self.m2 = batch_mean, batch_m2
+        else:
+            total = self.count + n
+            delta = batch_mean - self.mean
+            self.mean = self.mean + delta * (n / total)
+            self.m2 = self.m2 + batch_m2 + delta**2 * (self.count * n / total)
+        self.count += n
+        return self
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / self.count)
+
+
+class FmriDecoder(object):
+    """
+    Everything needed to decode raw fMRI into features: the fMRI scale
+    factor and train normalisation, the ridge weights, the train target
+    statistics and running statistics of the predictions, which replace
+    the batch re-standardisation over the whole test set.
+
+    The running statistics are seeded with the test predictions at fit
+    time, so single samples can be decoded right away, and stay frozen
+    after that. Updating them with each new mini-batch (update_stats) is
+    a deliberate domain-adaptation mode: predictions then follow a drift
+    of the incoming scans, but depend on what was decoded before.
+    """
+    def __init__(self, weights, fmri_scale, norm_mean, norm_scale,
+                 target_mean, target_std, pred_stats=None):
+        self.weights = weights
+        self.fmri_scale = fmri_scale
+        self.norm_mean = np.asarray(norm_mean)
+        self.norm_scale = np.asarray(norm_scale)
+        self.target_mean = np.asarray(target_mean)
+        self.target_std = np.asarray(target_std)
+        self.pred_stats = RunningStats() if pred_stats is None else pred_stats
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        weights = load_regression_weights(path, mmap_mode=mmap_mode)
+        pred_stats = RunningStats(
+            count=weights.header.get('pred_count', 0),
+            mean=weights.get('pred_mean'),
+            std=weights.get('pred_std'), )
+        return cls(
+            weights,
+            fmri_scale=weights.header['fmri_scale'],
+            norm_mean=weights['norm_mean'],
+            norm_scale=weights['norm_scale'],
+            target_mean=weights['target_mean'],
+            target_std=weights['target_std'],
+            pred_stats=pred_stats, )
+
+    def save(self, out_dir, weight_dtype='float32'):
+        arrays = {k: self.weights[k] for k in WEIGHT_ARRAYS if k in self.weights}
+        arrays.update({
+            'norm_mean': self.norm_mean,
+            'norm_scale': self.norm_scale,
+            'target_mean': self.target_mean,
+            'target_std': self.target_std, })
+        header = {k: v for k, v in self.weights.header.items() if k not in ('format_version', 'arrays')}
+        header['fmri_scale'] = self.fmri_scale
+        header['feature_shape'] = list(self.weights.feature_shape)
+        header['pred_count'] = self.pred_stats.count
+        if self.pred_stats.count > 0:
+            arrays['pred_mean'] = self.pred_stats.mean
+            arrays['pred_std'] = self.pred_stats.std
+        save_regression_weights(out_dir, arrays, header=header, weight_dtype=weight_dtype)
+
+    def normalise(self, fmri):
+        return (np.asarray(fmri) / self.fmri_scale - self.norm_mean) / self.norm_scale
+
+    def predict_raw(self, fmri):
+        """Ridge prediction before re-standardisation."""
+        return self.weights.project(self.normalise(fmri)) + self.weights.bias
+
+    def update_stats(self, fmri):
+        self.pred_stats.update(self.predict_raw(fmri))
+
+    def predict(self, fmri, update_stats=False):
+        """
+        Decodes a single sample (voxels,) or a mini-batch (n, voxels) of
+        raw fMRI. With update_stats the batch is merged into the running
+        prediction statistics before re-standardising.
+        """
+        fmri = np.asarray(fmri)
+        single = fmri.ndim == 1
+        if single:
+            fmri = fmri[None]
+        pred = self.predict_raw(fmri)
+        if update_stats:
+            self.pred_stats.update(pred)
+        if self.pred_stats.count < 2:
+            raise ValueError('Prediction statistics need at least two samples, '
+                             'decode a larger batch with update_stats or load a fitted decoder')
+        pred = (pred - self.pred_stats.mean) / self.pred_stats.std
+        pred = (pred * self.target_std + self.target_mean).astype(self.weights.bias.dtype)
+        return pred[0] if single else pred
+
+
+_pca_locks = {}
+_pca_locks_guard = threading.Lock()
+
+
+def fmri_pca_basis(fmri, n_components, cache_path=None, random_state=0, log=print):
+    """
+    Randomized PCA basis (voxels, n_components) of the normalised train
+    fMRI, cached at cache_path. Regressions then run on fmri @ basis. With
+    n_components >= number of train samples the ridge solution is exactly
+    the voxel-space one, since it lies in the row space of the train fMRI.
+    """
+    with _pca_locks_guard:
+        lock = _pca_locks.setdefault(cache_path, threading.Lock())
+    # Regressions of the same subject may run concurrently, compute the basis once
+    with lock:
+        if cache_path is not None and os.path.exists(cache_path):
+            basis = np.load(cache_path)
+            if basis.shape == (fmri.shape[1], n_components):
+                return basis
+        return _compute_fmri_pca_basis(fmri, n_components, cache_path, random_state, log=log)
+
+
+def _compute_fmri_pca_basis(fmri, n_components, cache_path, random_state, log=print):
+    from sklearn.utils.extmath import randomized_svd
+    _, s, vt = randomized_svd(np.asarray(fmri), n_components, random_state=random_state)
+    explained = (s**2).sum() / (np.asarray(fmri)**2).sum()
+    log('fMRI PCA: {} components explain {:.3f} of the variance'.format(n_components, explained))
+    basis = np.ascontiguousarray(vt.T, dtype=np.float32)
+    if cache_path is not None:
+        np.save(cache_path, basis)
+    return basis
+
+
+def fit_reduced_rank_ridge(fmri, targets, alpha, rank, max_iter=50000, random_state=0, voxel_basis=None):
+    """
+    Reduced-rank ridge regression. The flattened targets are projected on
+    their top principal directions (randomized SVD), a single multi-output
+    ridge is fitted in that subspace and the basis is kept to map
+    predictions back to full token embeddings. Since ridge is linear in
+    the targets this equals projecting the per-token ridge solutions with
+    the same alpha onto the basis. voxel_basis, if fmri was PCA-reduced,
+    is stored with the weights.
+    """
+    import sklearn.linear_model as skl
+    from sklearn.utils.extmath import randomized_svd
+    feature_shape = targets.shape[1:]
+    # Copy in the fit dtype, centred in place, so the targets are not duplicated
+    dtype = np.result_type(fmri.dtype, np.float32)
+    y = np.array(targets.reshape(len(targets), -1), dtype=dtype)
+    target_mean = y.mean(axis=0)
+    y -= target_mean
+    _, _, basis = randomized_svd(y, rank, random_state=random_state)
+    y_low = y @ basis.T
+    del y
+
+    reg = skl.Ridge(alpha=alpha, max_iter=max_iter, fit_intercept=True)
+    reg.fit(fmri, y_low)
+    bias = target_mean + reg.intercept_ @ basis
+    return RegressionWeights.from_arrays(
+        {'weight': reg.coef_.astype(dtype),
+         'bias': bias.reshape(feature_shape).astype(dtype),
+         'target_basis': basis.astype(dtype),
+         'voxel_basis': voxel_basis},
+        {'alpha': alpha, 'rank': rank}, )
+
+
+
+# Ridge settings of each feature space. The CLIP embeddings are regressed
+# token by token to bound memory, VDVAE latents with a single ridge.
+FMRI_SCALE = 300
+FEATURE_SPACES = {
+    'vdvae': {'alpha': 50000, 'max_iter': 10000, 'per_token': False},
+    'cliptext': {'alpha': 100000, 'max_iter': 50000, 'per_token': True},
+    'clipvision': {'alpha': 60000, 'max_iter': 50000, 'per_token': True},
+}
+
+
+def predicted_features_path(sub, name, num_layers=VDVAE_LAYERS):
+    if name == 'vdvae':
+        return 'data/predicted_features/subj{:02d}/nsd_vdvae_nsdgeneral_pred_sub{}_{}l_alpha50k.npy'.format(sub, sub, num_layers)
+    return 'data/predicted_features/subj{:02d}/nsd_{}_predtest_nsdgeneral.npy'.format(sub, name)
+
+
+def load_fmri(sub):
+    train_path = 'data/processed_data/subj{:02d}/nsd_train_fmriavg_nsdgeneral_sub{}.npy'.format(sub, sub)
+    test_path = 'data/processed_data/subj{:02d}/nsd_test_fmriavg_nsdgeneral_sub{}.npy'.format(sub, sub)
+    return np.load(train_path), np.load(test_path)
+
+
+def load_test_stimulus_index(sub):
+    """NSD ids of the test images in the order of the test arrays, None if prepare_nsddata.py predates them."""
+    path = 'data/processed_data/subj{:02d}/nsd_test_stimidx_sub{}.npy'.format(sub, sub)
+    return np.load(path) if os.path.exists(path) else None
+
+
+def vdvae_features_path(sub, num_layers=VDVAE_LAYERS):
+    return 'data/extracted_features/subj{:02d}/nsd_vdvae_features_{}l.npz'.format(sub, num_layers)
+
+
+def load_features(sub, name, split, mmap_mode=None, num_layers=VDVAE_LAYERS):
+    assert split in ['train', 'test']
+    if name == 'vdvae':
+        # Fewer layers are a prefix of the flat latents, so the default extraction can be reused
+        path = vdvae_features_path(sub, num_layers)
+        if not os.path.exists(path) and num_layers < VDVAE_LAYERS:
+            path = vdvae_features_path(sub)
+        nsd_features = np.load(path)
+        return nsd_features['{}_latents'.format(split)][:, :vdvae_latent_dims(num_layers)]
+    return np.load('data/extracted_features/subj{:02d}/nsd_{}_{}.npy'.format(sub, name, split), mmap_mode=mmap_mode)
+
+
+def normalise_fmri(train_fmri, test_fmri, fmri_scale=FMRI_SCALE, log=print):
+    """Scales the fMRI and z-scores both splits with the train statistics."""
+    train_fmri = train_fmri/fmri_scale
+    test_fmri = test_fmri/fmri_scale
+
+    norm_mean_train = np.mean(train_fmri, axis=0)
+    norm_scale_train = np.std(train_fmri, axis=0, ddof=1)
+    train_fmri = (train_fmri - norm_mean_train) / norm_scale_train
+    test_fmri = (test_fmri - norm_mean_train) / norm_scale_train
+
+    log(np.mean(train_fmri),np.std(train_fmri))
+    log(np.mean(test_fmri),np.std(test_fmri))
+
+    log(np.max(train_fmri),np.min(train_fmri))
+    log(np.max(test_fmri),np.min(test_fmri))
+    return train_fmri, test_fmri, norm_mean_train, norm_scale_train
+
+
+def fit_ridge_weights(train_fmri, test_fmri, train_targets, test_targets, alpha, max_iter,
+                      per_token=False, rank=0, voxel_basis=None, log=print):
+    """
+    Fits the ridge regression of one feature space, printing the test
+    scores, and returns its RegressionWeights. train_fmri/test_fmri are
+    already normalised (and PCA-reduced when voxel_basis is given). The
+    weights keep the dtype of train_fmri; they are only cast to the
+    storage dtype when saved.
+    """
+    import sklearn.linear_model as skl
+    from sklearn.metrics import r2_score
+    header = {'alpha': alpha}
+
+    if rank > 0:
+        log("Training Reduced-Rank Regression, rank {}".format(rank))
+        weights = fit_reduced_rank_ridge(train_fmri, train_targets, alpha=alpha, rank=rank,
+                                         max_iter=max_iter, voxel_basis=voxel_basis)
+        # test_fmri may already be PCA-reduced, so project without the voxel basis
+        pred_test = (test_fmri @ weights.weight.T) @ weights['target_basis']
+        pred_test = pred_test.reshape(test_targets.shape) + weights.bias
+        for i in range(train_targets.shape[1]):
+            log(i, r2_score(test_targets[:,i], pred_test[:,i]))
+        return weights
+
+    if not per_token:
+        log('Training Regression')
+        reg = skl.Ridge(alpha=alpha, max_iter=max_iter, fit_intercept=True)
+        reg.fit(train_fmri, train_targets)
+        log(reg.score(test_fmri, test_targets))
+        return RegressionWeights.from_arrays(
+            {'weight': reg.coef_, 'bias': reg.intercept_, 'voxel_basis': voxel_basis}, header)
+
+    log('Training Regression')
+    num_samples, num_embed, num_dim = train_targets.shape
+    dtype = np.result_type(train_fmri.dtype, np.float32)
+    reg_w = np.zeros((num_embed, num_dim, train_fmri.shape[1]), dtype=dtype)
+    reg_b = np.zeros((num_embed, num_dim), dtype=dtype)
+    for i in range(num_embed):
+        reg = skl.Ridge(alpha=alpha, max_iter=max_iter, fit_intercept=True)
+        reg.fit(train_fmri, train_targets[:,i])
+        reg_w[i] = reg.coef_
+        reg_b[i] = reg.intercept_
+        log(i, reg.score(test_fmri, test_targets[:,i]))
+    return RegressionWeights.from_arrays(
+        {'weight': reg_w, 'bias': reg_b, 'voxel_basis': voxel_basis}, header)
+
+
+def fit_decoder(fmri, train_targets, test_targets, name, rank=0, n_pca=0,
+                pca_cache_path=None, dtype=np.float64, log=print):
+    """
+    Fits the fMRI decoder of one feature space. fmri is a (train, test)
+    pair of raw fMRI arrays. With dtype float32 the fMRI and targets are
+    cast once up front and normalisation, the ridge solve and prediction
+    all stay in float32.
+    """
+    settings = FEATURE_SPACES[name]
+    fmri = tuple(np.asarray(f, dtype=dtype) for f in fmri)
+    train_targets = np.asarray(train_targets, dtype=dtype)
+    test_targets = np.asarray(test_targets, dtype=dtype)
+
+    train_fmri, test_fmri, norm_mean, norm_scale = normalise_fmri(*fmri, log=log)
+    voxel_basis = None
+    if n_pca > 0:
+        # Ridge runs on the (cached) PCA components, the basis maps the weights back to voxel space
+        voxel_basis = fmri_pca_basis(train_fmri, n_pca, cache_path=pca_cache_path, log=log).astype(dtype)
+        train_fmri = train_fmri @ voxel_basis
+        test_fmri = test_fmri @ voxel_basis
+
+    weights = fit_ridge_weights(train_fmri, test_fmri, train_targets, test_targets,
+                                alpha=settings['alpha'], max_iter=settings['max_iter'],
+                                per_token=settings['per_token'], rank=rank,
+                                voxel_basis=voxel_basis, log=log)
+
+    return FmriDecoder(weights, fmri_scale=FMRI_SCALE, norm_mean=norm_mean, norm_scale=norm_scale,
+                       target_mean=np.mean(train_targets, axis=0), target_std=np.std(train_targets, axis=0))
+
+
+def train_decoder(sub, name, fmri=None, train_targets=None, test_targets=None,
+                  rank=0, n_pca=0, dtype=np.float64, weight_dtype='float32',
+                  num_layers=VDVAE_LAYERS, log=print):
+    """
+    Trains the fMRI decoder of one subject and feature space and writes
+    the test predictions and the decoder. Inputs that are not given are
+    loaded from disk; fmri is a (train, test) pair of raw fMRI arrays.
+    num_layers is the number of regressed VDVAE latent layers.
+    """
+    if fmri is None:
+        fmri = load_fmri(sub)
+    if train_targets is None:
+        # Memory-mapped, so a float32 run never holds the float64 features in memory
+        train_targets = load_features(sub, name, 'train', mmap_mode='r', num_layers=num_layers)
+    if test_targets is None:
+        test_targets = load_features(sub, name, 'test', num_layers=num_layers)
+
+    decoder = fit_decoder(fmri, train_targets, test_targets, name, rank=rank, n_pca=n_pca,
+                          pca_cache_path=fmri_pca_path(sub, n_pca), dtype=dtype, log=log)
+    # Re-standardises with the statistics of the whole test set, which are kept for decoding new samples
+    pred_test = decoder.predict(np.asarray(fmri[1], dtype=dtype), update_stats=True)
+
+    np.save(predicted_features_path(sub, name, num_layers), pred_test)
+    decoder.save(regression_weights_path(sub, name, num_layers), weight_dtype=weight_dtype)
+    return decoder
+
+
+def group_metrics(targets, pred):
+    """
+    R² (as Ridge.score) and mean Pearson correlation across samples for
+    each feature group: per token of (n, tokens, dim) CLIP embeddings, per
+    layer of flat (n, layers) VDVAE latents, otherwise a single group.
+    """
+    n = len(targets)
+    if targets.ndim == 3:
+        bounds = np.arange(targets.shape[1] + 1) * targets.shape[2]
+    elif targets.shape[1] in np.cumsum(VDVAE_LAYER_DIMS):
+        bounds = np.cumsum([0] + VDVAE_LAYER_DIMS)
+        bounds = bounds[bounds <= targets.shape[1]]
+    else:
+        bounds = np.array([0, targets.shape[1]])
+    targets = np.asarray(targets, dtype=np.float64).reshape(n, -1)
+    pred = np.asarray(pred, dtype=np.float64).reshape(n, -1)
+
+    residual = ((targets - pred)**2).sum(axis=0)
+    total = ((targets - targets.mean(axis=0))**2).sum(axis=0)
+    # Constant columns count as perfectly predicted, as in sklearn's r2_score
+    r2 = np.where(total > 0, 1 - residual / np.where(total > 0, total, 1), 1.0)
+    zt = (targets - targets.mean(axis=0)) / (targets.std(axis=0) + 1e-12)
+    zp = (pred - pred.mean(axis=0)) / (pred.std(axis=0) + 1e-12)
+    corr = (zt * zp).mean(axis=0)
+
+    r2 = np.array([r2[s:e].mean() for s, e in zip(bounds[:-1], bounds[1:])])
+    corr = np.array([corr[s:e].mean() for s, e in zip(bounds[:-1], bounds[1:])])
+    return r2, corr
+
+
+def r2_scores(targets, pred):
+    """Ridge.score of the predictions, per token for (n, tokens, dim) targets."""
+    from sklearn.metrics import r2_score
+    if targets.ndim == 2:
+        return np.array([r2_score(targets, pred)])
+    return np.array([r2_score(targets[:,i], pred[:,i]) for i in range(targets.shape[1])])
+
+
+def make_synthetic_data(num_train, num_test, num_voxels, feature_shape,
+                        num_latent=64, noise=1.0, seed=0):
+    """
+    Random fMRI/feature pairs shaped like the NSD data: raw fMRI around
+    the scale of the betas and features that are linear in a latent shared
+    with the fMRI, plus noise. Returns ((train_fmri, test_fmri),
+    train_targets, test_targets).
+    """
+    rng = np.random.RandomState(seed)
+    num = num_train + num_test
+    num_features = int(np.prod(feature_shape))
+    latent = rng.randn(num, num_latent)
+    fmri = latent @ rng.randn(num_latent, num_voxels) / np.sqrt(num_latent) + noise * rng.randn(num, num_voxels)
+    fmri = FMRI_SCALE * fmri + rng.randn(num_voxels) * FMRI_SCALE
+    targets = latent @ rng.randn(num_latent, num_features) / np.sqrt(num_latent) + noise * rng.randn(num, num_features)
+    targets = targets.reshape((num,) + tuple(feature_shape))
+    return (fmri[:num_train], fmri[num_train:]), targets[:num_train], targets[num_train:]
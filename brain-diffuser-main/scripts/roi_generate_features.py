@@ -1,5 +1,5 @@
 import numpy as np
-import pickle
+from regression_utils import load_regression_weights, regression_weights_path
 
 import argparse
 parser = argparse.ArgumentParser(description='Argument Parser')
@@ -10,14 +10,13 @@ assert sub in [1,2,5,7]
 
 # Load ROI Masks
 
-with open('data/regression_weights/subj{:02d}/vdvae_regression_weights.pkl'.format(sub),"rb") as f:
-    datadict = pickle.load(f)
-    reg_w = datadict['weight']
-    reg_b = datadict['bias']
+# Weights are memory-mapped and only read chunk by chunk while projecting
+weights = load_regression_weights(regression_weights_path(sub,'vdvae'))
+reg_b = np.asarray(weights.bias)
 
 roi_dir = 'data/processed_data/subj{:02d}/roi'.format(sub)
 num_rois = 13
-roi_act=np.zeros((num_rois,reg_w.shape[1])).astype(np.float32)
+roi_act=np.zeros((num_rois,weights.num_voxels)).astype(np.float32)
 roi_act[0] = np.load("{}/floc-faces.npy".format(roi_dir))
 roi_act[1] = np.load("{}/floc-words.npy".format(roi_dir))
 roi_act[2] = np.load("{}/floc-places.npy".format(roi_dir))
@@ -41,7 +40,7 @@ roi_act[roi_act<0]=0
 nsd_features = np.load('data/extracted_features/subj{:02d}/nsd_vdvae_features_31l.npz'.format(sub))
 train_latents = nsd_features['train_latents']
 
-pred_vae = (roi_act @ reg_w.T) 
+pred_vae = weights.project(roi_act)
 pred_vae = pred_vae / (np.linalg.norm(pred_vae,axis=1).reshape((num_rois,1)) + 1e-8)
 pred_vae = pred_vae * 50 + reg_b
 
@@ -54,14 +53,11 @@ np.save('data/predicted_features/subj{:02d}/nsd_vdvae_nsdgeneral_roi_sub{}_31l_a
 
 # Generate CLIP-Text Features
 
-with open('data/regression_weights/subj{:02d}/cliptext_regression_weights.pkl'.format(sub),"rb") as f:
-    datadict = pickle.load(f)
-    reg_w = datadict['weight']
-    reg_b = datadict['bias']
+weights = load_regression_weights(regression_weights_path(sub,'cliptext'))
+reg_b = np.asarray(weights.bias)
 
-pred_clipt = np.zeros((num_rois,reg_w.shape[0],reg_w.shape[1])).astype(np.float32)
-for j in range(reg_w.shape[0]):
-    pred_clipt[:,j] = (roi_act @ reg_w[j].T) 
+# Projected one token block at a time from the memory-mapped weights
+pred_clipt = weights.project(roi_act)
     
 pred_clipt = pred_clipt / (np.linalg.norm(pred_clipt,axis=(1,2)).reshape((num_rois,1,1)) + 1e-8)
 pred_clipt = pred_clipt * 9 + reg_b
@@ -70,14 +66,11 @@ np.save('data/predicted_features/subj{:02d}/nsd_cliptext_roi_nsdgeneral.npy'.for
 
 # Generate CLIP-Vision Features
 
-with open('data/regression_weights/subj{:02d}/clipvision_regression_weights.pkl'.format(sub),"rb") as f:
-    datadict = pickle.load(f)
-    reg_w = datadict['weight']
-    reg_b = datadict['bias']
-    
-pred_clipv = np.zeros((num_rois,reg_w.shape[0],reg_w.shape[1])).astype(np.float32)
-for j in range(reg_w.shape[0]):
-    pred_clipv[:,j] = (roi_act @ reg_w[j].T) 
+weights = load_regression_weights(regression_weights_path(sub,'clipvision'))
+reg_b = np.asarray(weights.bias)
+
+# Projected one token block at a time from the memory-mapped weights
+pred_clipv = weights.project(roi_act)
     
 pred_clipv = pred_clipv / (np.linalg.norm(pred_clipv,axis=(1,2)).reshape((num_rois,1,1)) + 1e-8)
 pred_clipv = pred_clipv * 15 + reg_b
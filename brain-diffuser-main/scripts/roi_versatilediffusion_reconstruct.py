@@ -17,6 +17,7 @@ from lib.experiments.sd_default import color_adjust, auto_merge_imlist
 from torch.utils.data import DataLoader, Dataset
 
 from lib.model_zoo.vd import VD
+from lib.model_zoo.vd_checkpoint import load_vd_model
 from lib.cfg_holder import cfg_unique_holder as cfguh
 from lib.cfg_helper import get_command_line_args, cfg_initiates, load_cfg_yaml
 import matplotlib.pyplot as plt
@@ -27,11 +28,18 @@ parser = argparse.ArgumentParser(description='Argument Parser')
 parser.add_argument("-sub", "--sub",help="Subject Number",default=1)
 parser.add_argument("-diff_str", "--diff_str",help="Diffusion Strength",default=0.75)
 parser.add_argument("-mix_str", "--mix_str",help="Mixing Strength",default=0.4)
+parser.add_argument("-precision", "--precision",help="Precision of the diffusion model and autokl: float32, bfloat16 (use on CPU) or float16",default='float16')
+parser.add_argument("-clip_precision", "--clip_precision",help="Precision of CLIP: float32, bfloat16 or float16",default='float32')
+parser.add_argument("-autocast", "--autocast",help="Keep float32 weights and run the models under autocast in the given precision",action='store_true')
+parser.add_argument("-devices", "--devices",help="Devices of CLIP/autokl and of the diffusion model, comma separated ('cpu' for both on CPU)",default='cuda:0,cuda:1')
 args = parser.parse_args()
 sub=int(args.sub)
 assert sub in [1,2,5,7]
 strength = float(args.diff_str)
 mixing = float(args.mix_str)
+devices = args.devices.split(',')
+# CLIP and autokl run on the first device, the diffusion model on the last one
+device, unet_device = devices[0], devices[-1]
 
 
 def regularize_image(x):
@@ -54,30 +62,31 @@ def regularize_image(x):
             'Wrong image size'
         return x
 
-cfgm_name = 'vd_noema'
+cfgm_name = 'vd_noema_image'
 sampler = DDIMSampler_VD
 pth = 'versatile_diffusion/pretrained/vd-four-flow-v1-0-fp16-deprecated.pth'
 cfgm = model_cfg_bank()(cfgm_name)
-net = get_model()(cfgm)
-sd = torch.load(pth, map_location='cpu')
-net.load_state_dict(sd, strict=False)    
+# Set before loading so mapped float16 weights are not cast to float32 and back
+cfgm.args.precision, cfgm.args.autocast = args.precision, args.autocast
+cfgm.args.clip_precision = args.clip_precision
+net = load_vd_model(cfgm, pth)
 
 
 # Might require editing the GPU assignments due to Memory issues
-net.clip.cuda(0)
-net.autokl.cuda(0)
+net.clip.to(device)
+net.autokl.to(device)
+# Before the sampler makes its schedule, which goes to the diffusion model's device
+net.model.diffusion_model.device = unet_device
+net.model.diffusion_model.to(unet_device)
 
-#net.model.cuda(1)
 sampler = sampler(net)
-#sampler.model.model.cuda(1)
-#sampler.model.cuda(1)
 batch_size = 1
 
 pred_text = np.load('data/predicted_features/subj{:02d}/nsd_cliptext_roi_nsdgeneral.npy'.format(sub))
-pred_text = torch.tensor(pred_text).half().cuda(1)
+pred_text = torch.tensor(pred_text).to(unet_device)
 
 pred_vision = np.load('data/predicted_features/subj{:02d}/nsd_clipvision_roi_nsdgeneral.npy'.format(sub))
-pred_vision = torch.tensor(pred_vision).half().cuda(1)
+pred_vision = torch.tensor(pred_vision).to(unet_device)
 
 
 n_samples = 1
@@ -86,7 +95,6 @@ ddim_eta = 0
 scale = 7.5
 xtype = 'image'
 ctype = 'prompt'
-net.autokl.half()
 
 res_dir = 'results/versatile_diffusion/subj{:02d}/roi/'.format(sub)
 if not os.path.exists(res_dir):
@@ -99,7 +107,7 @@ for im_id in range(len(pred_vision)):
    
     zim = regularize_image(zim)
     zin = zim*2 - 1
-    zin = zin.unsqueeze(0).cuda(0).half()
+    zin = zin.unsqueeze(0).to(device)
 
     init_latent = net.autokl_encode(zin)
     
@@ -107,19 +115,16 @@ for im_id in range(len(pred_vision)):
     #strength=0.75
     assert 0. <= strength <= 1., 'can only work with strength in [0.0, 1.0]'
     t_enc = int(strength * ddim_steps)
-    device = 'cuda:0'
     z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]).to(device))
     #z_enc,_ = sampler.encode(init_latent.cuda(1).half(), c.cuda(1).half(), torch.tensor([t_enc]).to(sampler.model.model.diffusion_model.device))
 
-    dummy = ''
-    utx = net.clip_encode_text(dummy)
-    utx = utx.cuda(1).half()
+    utx = net.clip_encode_null('prompt')
+    utx = utx.to(unet_device)
     
-    dummy = torch.zeros((1,3,224,224)).cuda(0)
-    uim = net.clip_encode_vision(dummy)
-    uim = uim.cuda(1).half()
+    uim = net.clip_encode_null('vision')
+    uim = uim.to(unet_device)
     
-    z_enc = z_enc.cuda(1)
+    z_enc = z_enc.to(unet_device)
 
     h, w = 512,512
     shape = [n_samples, 4, h//8, w//8]
@@ -130,8 +135,6 @@ for im_id in range(len(pred_vision)):
     #c[:,0] = u[:,0]
     #z_enc = z_enc.cuda(1).half()
     
-    sampler.model.model.diffusion_model.device='cuda:1'
-    sampler.model.model.diffusion_model.half().cuda(1)
     #mixing = 0.4
     
     z = sampler.decode_dc(
@@ -145,7 +148,7 @@ for im_id in range(len(pred_vision)):
         second_ctype='prompt',
         mixed_ratio=(1-mixing), )
     
-    z = z.cuda(0).half()
+    z = z.to(device)
     x = net.autokl_decode(z)
     color_adj='None'
     #color_adj_to = cin[0]
@@ -0,0 +1,54 @@
+import sys
+sys.path.append('versatile_diffusion')
+import torch
+from lib.model_zoo.attention import CrossAttention, SpatialSelfAttention, set_attention_backend, ATTENTION_BACKENDS
+from lib.model_zoo.diffusion_modules import AttnBlock
+from benchmark_utils import measure, peak_memory
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-bs", "--bs",help="Images per DDIM trajectory (the guided UNet batch is twice this)",default=1)
+parser.add_argument("-res", "--res",help="Latent resolution",default=64)
+parser.add_argument("-backends", "--backends",help="Comma separated attention backends",default='einsum,sdpa,chunked')
+parser.add_argument("-reps", "--reps",help="Timed repetitions",default=3)
+parser.add_argument("-device", "--device",help="Device to benchmark on",default='cpu')
+parser.add_argument("-dtype", "--dtype",help="Precision to benchmark in",default='float32')
+args = parser.parse_args()
+batch_size, res, reps = int(args.bs), int(args.res), int(args.reps)
+device = torch.device(args.device)
+dtype = getattr(torch, args.dtype)
+backends = [b for b in args.backends.split(',') if b != 'sdpa' or hasattr(torch.nn.functional, 'scaled_dot_product_attention')]
+assert all(b in ATTENTION_BACKENDS for b in backends)
+
+
+def make(module):
+    for p in module.parameters():
+        p.data.normal_(0, 0.02)
+    return module.to(device=device, dtype=dtype).eval().requires_grad_(False)
+
+
+torch.manual_seed(0)
+n = res * res
+tokens = torch.randn(2 * batch_size, n, 320, device=device, dtype=dtype)
+context = torch.randn(2 * batch_size, 257, 768, device=device, dtype=dtype)
+# Attention layers at the first level of the VD image UNet and in the autoencoder middle block
+cases = [
+    ('UNet self-attention', make(CrossAttention(320, heads=8, dim_head=40)), lambda m: m(tokens)),
+    ('UNet cross-attention', make(CrossAttention(320, context_dim=768, heads=8, dim_head=40)), lambda m: m(tokens, context)),
+    ('SpatialSelfAttention', make(SpatialSelfAttention(320)),
+     lambda m, x=torch.randn(2 * batch_size, 320, res, res, device=device, dtype=dtype): m(x)),
+    ('autokl AttnBlock', make(AttnBlock(512)),
+     lambda m, x=torch.randn(batch_size, 512, res, res, device=device, dtype=dtype): m(x)), ]
+
+print('{}x{} latents, batch {} on {} in {}'.format(res, res, batch_size, device, args.dtype))
+for name, module, run in cases:
+    set_attention_backend(module, 'einsum')
+    with torch.no_grad():
+        ref = run(module).float()
+    for backend in backends:
+        set_attention_backend(module, backend)
+        with torch.no_grad():
+            diff = (run(module).float() - ref).abs().max().item()
+        ms = measure(lambda: run(module), reps, device)
+        print('{:<22} {:<8} {:9.1f}ms  peak {:8.1f}MB  max abs diff {:.2e}'.format(
+            name, backend, ms, peak_memory(lambda: run(module), device), diff))
@@ -0,0 +1,67 @@
+import sys
+sys.path.append('vdvae')
+import torch
+import numpy as np
+from vae import VAE
+from vae_inference import build_inference_decoder
+from benchmark_utils import measure, peak_memory
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-bs", "--bs",help="Batch Size",default=4)
+parser.add_argument("-width", "--width",help="Decoder width (512 for the pretrained imagenet64 model)",default=512)
+parser.add_argument("-layers", "--layers",help="Number of conditioned latent layers",default=31)
+parser.add_argument("-reps", "--reps",help="Timed repetitions",default=3)
+parser.add_argument("-backends", "--backends",help="Comma separated inference decoder backends",default='eager,script,compile')
+parser.add_argument("-device", "--device",help="Device to benchmark on",default='cpu')
+parser.add_argument("-memory", "--memory",help="Also measure the peak memory of each decoder",action='store_true')
+args = parser.parse_args()
+batch_size, num_layers, reps = int(args.bs), int(args.layers), int(args.reps)
+device = torch.device(args.device)
+backends = [b for b in args.backends.split(',') if b != 'compile' or hasattr(torch, 'compile')]
+
+class dotdict(dict):
+    """dot.notation access to dictionary attributes"""
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+# Architecture of the pretrained imagenet64 model, randomly initialised
+H = dotdict({'image_size': 64, 'image_channels': 3, 'dataset': 'imagenet64', 'enc_blocks': '64x11,64d2,32x20,32d2,16x9,16d2,8x8,8d2,4x7,4d4,1x5',
+             'dec_blocks': '1x2,4m1,4x3,8m4,8x7,16m8,16x15,32m16,32x31,64m32,64x12', 'zdim': 16, 'width': int(args.width),
+             'custom_width_str': '', 'bottleneck_multiple': 0.25, 'no_bias_above': 64, 'num_mixtures': 10})
+torch.manual_seed(0)
+decoder = VAE(H).decoder.to(device).eval().requires_grad_(False)
+for p in decoder.parameters():
+    p.data.normal_(0, 0.02)
+layout = decoder.latent_layout[:num_layers]
+flat = torch.randn(batch_size, layout.total, device=device)
+latents = layout.split(flat)
+# Parity is checked with every layer conditioned, as torch.compile draws the
+# prior samples of the remaining layers from a different random stream
+flat_all = torch.randn(batch_size, decoder.latent_layout.total, device=device)
+latents_all = decoder.latent_layout.split(flat_all)
+
+
+def report(name, fn, ms, diff=None):
+    line = '{:<26} {:9.1f}ms'.format(name, ms)
+    if diff is not None:
+        line += '  ({:.2f}x)  max abs diff {:.2e}'.format(ref_ms / ms, diff)
+    if args.memory:
+        line += '  peak {:8.1f}MB'.format(peak_memory(fn, device))
+    print(line)
+
+
+# The TorchScript profiling executor and torch.compile optimise on the first calls
+ref_ms = measure(lambda: decoder.forward_manual_latents(batch_size, flat, t=None), reps, device, warmup=3)
+with torch.no_grad():
+    ref = decoder.forward_manual_latents(batch_size, flat_all, t=None)
+print('{} images, width {}, {} conditioned layers on {}'.format(batch_size, H.width, num_layers, device))
+report('Decoder', lambda: decoder.forward_manual_latents(batch_size, flat, t=None), ref_ms)
+for backend in backends:
+    inference_decoder = build_inference_decoder(decoder, backend)
+    decode = lambda: inference_decoder(latents, batch_size, 0.)
+    ms = measure(decode, reps, device, warmup=3)
+    with torch.no_grad():
+        out = inference_decoder(latents_all, batch_size, 0.)
+    report('InferenceDecoder ' + backend, decode, ms, (out - ref).abs().max().item())
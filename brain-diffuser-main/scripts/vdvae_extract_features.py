@@ -32,6 +32,7 @@ import argparse
 parser = argparse.ArgumentParser(description='Argument Parser')
 parser.add_argument("-sub", "--sub",help="Subject Number",default=1)
 parser.add_argument("-bs", "--bs",help="Batch Size",default=30)
+parser.add_argument("-layers", "--layers",help="Number of latent layers to extract",default=31)
 args = parser.parse_args()
 sub=int(args.sub)
 assert sub in [1,2,5,7]
@@ -79,20 +80,27 @@ test_images = batch_generator_external_images(data_path = image_path)
 
 trainloader = DataLoader(train_images,batch_size,shuffle=False)
 testloader = DataLoader(test_images,batch_size,shuffle=False)
-num_latents = 31
+num_latents = int(args.layers)
+
+def keep_latents(batch_latent):
+  # Latents are streamed out of the decoder block by block and only the
+  # first num_latents blocks are run; the latents are copied to the CPU
+  # once per batch and encoder activations are freed after their last use
+  def callback(idx, block_stats):
+    if idx < num_latents:
+      batch_latent.append(block_stats['z'].flatten(1))
+  return callback
+
 test_latents = []
 for i,x in enumerate(testloader):
   data_input, target = preprocess_fn(x)
   with torch.no_grad():
         print(i*batch_size)
         activations = ema_vae.encoder.forward(data_input)
-        px_z, stats = ema_vae.decoder.forward(activations, get_latents=True)
-        #recons = ema_vae.decoder.out_net.sample(px_z)
         batch_latent = []
-        for i in range(num_latents):
-            #test_latents[i].append(stats[i]['z'].cpu().numpy())
-            batch_latent.append(stats[i]['z'].cpu().numpy().reshape(len(data_input),-1))
-        test_latents.append(np.hstack(batch_latent))
+        px_z, _ = ema_vae.decoder.forward(activations, latent_callback=keep_latents(batch_latent), release_activations=True, num_blocks=num_latents)
+        #recons = ema_vae.decoder.out_net.sample(px_z)
+        test_latents.append(torch.cat(batch_latent, dim=1).cpu().numpy())
 
 test_latents = np.concatenate(test_latents)  
 
@@ -102,13 +110,11 @@ for i,x in enumerate(trainloader):
   with torch.no_grad():
         print(i*batch_size)
         activations = ema_vae.encoder.forward(data_input)
-        px_z, stats = ema_vae.decoder.forward(activations, get_latents=True)
-        #recons = ema_vae.decoder.out_net.sample(px_z)
         batch_latent = []
-        for i in range(num_latents):
-            batch_latent.append(stats[i]['z'].cpu().numpy().reshape(len(data_input),-1))
-        train_latents.append(np.hstack(batch_latent))
+        px_z, _ = ema_vae.decoder.forward(activations, latent_callback=keep_latents(batch_latent), release_activations=True, num_blocks=num_latents)
+        #recons = ema_vae.decoder.out_net.sample(px_z)
+        train_latents.append(torch.cat(batch_latent, dim=1).cpu().numpy())
 train_latents = np.concatenate(train_latents)      
 
-np.savez("data/extracted_features/subj{:02d}/nsd_vdvae_features_31l.npz".format(sub),train_latents=train_latents,test_latents=test_latents)
+np.savez("data/extracted_features/subj{:02d}/nsd_vdvae_features_{}l.npz".format(sub,num_latents),train_latents=train_latents,test_latents=test_latents)
 
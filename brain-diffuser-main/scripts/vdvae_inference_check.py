@@ -0,0 +1,75 @@
+import sys
+sys.path.append('vdvae')
+import time
+import torch
+import numpy as np
+import vae as vae_module
+from vae import VAE
+from contextlib import contextmanager
+from vae_inference import prepare_for_inference
+
+import argparse
+parser = argparse.ArgumentParser(description='Argument Parser')
+parser.add_argument("-bs", "--bs",help="Batch Size",default=4)
+parser.add_argument("-width", "--width",help="Model width (512 for the pretrained imagenet64 model)",default=512)
+parser.add_argument("-dtypes", "--dtypes",help="Comma separated precisions of the inference blocks",default='float32,bfloat16')
+parser.add_argument("-device", "--device",help="Device to check on",default='cpu')
+args = parser.parse_args()
+batch_size = int(args.bs)
+device = torch.device(args.device)
+
+class dotdict(dict):
+    """dot.notation access to dictionary attributes"""
+    __getattr__ = dict.get
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+# Architecture of the pretrained imagenet64 model, randomly initialised
+H = dotdict({'image_size': 64, 'image_channels': 3, 'dataset': 'imagenet64', 'enc_blocks': '64x11,64d2,32x20,32d2,16x9,16d2,8x8,8d2,4x7,4d4,1x5',
+             'dec_blocks': '1x2,4m1,4x3,8m4,8x7,16m8,16x15,32m16,32x31,64m32,64x12', 'zdim': 16, 'width': int(args.width),
+             'custom_width_str': '', 'bottleneck_multiple': 0.25, 'no_bias_above': 64, 'num_mixtures': 10})
+torch.manual_seed(0)
+torch.set_grad_enabled(False)
+vae = VAE(H).to(device).eval()
+for p in vae.parameters():
+    p.data.normal_(0, 0.02)
+
+images = torch.randn(batch_size, 64, 64, 3, device=device)
+latents = [torch.randn((batch_size,) + shape, device=device) for shape in vae.decoder.latent_layout.shapes]
+
+
+@contextmanager
+def posterior_means():
+    """Makes DecBlock.sample return the posterior means, as noise draws differ between precisions."""
+    draw = vae_module.draw_gaussian_diag_samples
+    vae_module.draw_gaussian_diag_samples = lambda mu, logsigma: mu
+    try:
+        yield
+    finally:
+        vae_module.draw_gaussian_diag_samples = draw
+
+
+def run(model, dtype):
+    """Posterior mean latents of all layers, decoded px_z and mean-mode images."""
+    with posterior_means():
+        _, stats = model.decoder.forward(model.encoder.forward(images.to(dtype)), get_latents=True)
+    z = torch.cat([s['z'].float().flatten(1) for s in stats], dim=1)
+    start = time.perf_counter()
+    px_z = model.decoder.forward_manual_latents(batch_size, [l.to(dtype) for l in latents])
+    images_out = model.decoder.out_net.sample(px_z, mode='mean')
+    return z, px_z.float(), images_out, time.perf_counter() - start
+
+
+ref_z, ref_px_z, ref_images, ref_time = run(vae, torch.float32)
+print('Block              decode {:7.2f}s'.format(ref_time))
+for dtype in args.dtypes.split(','):
+    inference_H = dotdict(H, inference_blocks=True, inference_dtype=dtype)
+    model = VAE(inference_H).to(device).eval()
+    model.load_state_dict(vae.state_dict())
+    model = prepare_for_inference(model, inference_H)
+    z, px_z, images_out, elapsed = run(model, getattr(torch, dtype))
+    rel = lambda a, b: ((a - b).norm() / b.norm()).item()
+    diff = np.abs(images_out.astype(int) - ref_images)
+    print('InferenceBlock {:<9} decode {:7.2f}s | latents rel err {:.2e} | px_z rel err {:.2e} | '
+          'images max diff {} levels, {:.2%} of pixels differ'.format(
+              dtype, elapsed, rel(z, ref_z), rel(px_z, ref_px_z), diff.max(), (diff > 0).mean()))
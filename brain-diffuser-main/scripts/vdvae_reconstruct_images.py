@@ -19,6 +19,7 @@ from contextlib import contextmanager
 import torch.distributed as dist
 #from apex.optimizers import FusedAdam as AdamW
 from vae import VAE
+from vae_inference import build_inference_decoder
 from torch.nn.parallel.distributed import DistributedDataParallel
 from train_helpers import restore_params
 from image_utils import *
@@ -32,10 +33,24 @@ import argparse
 parser = argparse.ArgumentParser(description='Argument Parser')
 parser.add_argument("-sub", "--sub",help="Subject Number",default=1)
 parser.add_argument("-bs", "--bs",help="Batch Size",default=30)
+parser.add_argument("-mode", "--mode",help="Pixel decoding: sample from the mixture of logistics or take its (deterministic) mean",default='sample',choices=['sample','mean'])
+parser.add_argument("-decoder", "--decoder",help="Decoder implementation: the training decoder, or the inference decoder run eagerly, with TorchScript or with torch.compile",default='default',choices=['default','eager','script','compile'])
+parser.add_argument("-fast_blocks", "--fast_blocks",help="Use the inference optimised blocks on channels-last tensors",action='store_true')
+parser.add_argument("-precision", "--precision",help="Precision to run the model in",default='float32',choices=['float32','float16','bfloat16'])
+parser.add_argument("-samples", "--samples",help="Reconstructions per test image and temperature, decoded in the same batch",default=1)
+parser.add_argument("-temps", "--temps",help="Comma separated prior temperatures of the layers without predicted latents (empty keeps the prior scale, 0 takes the prior mean)",default='')
+parser.add_argument("-layers", "--layers",help="Number of regressed latent layers (see vdvae_regression.py -layers)",default=31)
 args = parser.parse_args()
 sub=int(args.sub)
 assert sub in [1,2,5,7]
 batch_size=int(args.bs)
+num_samples=int(args.samples)
+temperatures=[float(t) for t in args.temps.split(',')] if args.temps else None
+# Ensembles are written as {image}_t{temperature}_{sample}.png, a single
+# temperature is applied to the plain reconstructions
+ensemble = num_samples > 1 or (temperatures is not None and len(temperatures) > 1)
+temperature = temperatures[0] if temperatures is not None else None
+assert not ensemble or args.decoder == 'default', 'Ensembles are decoded with the default decoder'
 
 print('Libs imported')
 
@@ -47,92 +62,53 @@ class dotdict(dict):
     __delattr__ = dict.__delitem__
 H = dotdict(H)
 
+H.inference_blocks = args.fast_blocks
+H.inference_dtype = None if args.precision == 'float32' else args.precision
 H, preprocess_fn = set_up_data(H)
 
 print('Models is Loading')
 ema_vae = load_vaes(H)
 
-  
-class batch_generator_external_images(Dataset):
 
-    def __init__(self, data_path):
-        self.data_path = data_path
-        self.im = np.load(data_path).astype(np.uint8)
+pred_latents = np.load('data/predicted_features/subj{:02d}/nsd_vdvae_nsdgeneral_pred_sub{}_{}l_alpha50k.npy'.format(sub,sub,int(args.layers)))
 
-
-    def __getitem__(self,idx):
-        img = Image.fromarray(self.im[idx])
-        img = T.functional.resize(img,(64,64))
-        img = torch.tensor(np.array(img)).float()
-        #img = img/255
-        #img = img*2 - 1
-        return img
-
-    def __len__(self):
-        return  len(self.im)
-
-
-
-image_path = 'data/processed_data/subj{:02d}/nsd_test_stim_sub{}.npy'.format(sub,sub)
-test_images = batch_generator_external_images(data_path = image_path)
-testloader = DataLoader(test_images,batch_size,shuffle=False)
-
-test_latents = []
-for i,x in enumerate(testloader):
-  data_input, target = preprocess_fn(x)
-  with torch.no_grad():
-        print(i*batch_size)
-        activations = ema_vae.encoder.forward(data_input)
-        px_z, stats = ema_vae.decoder.forward(activations, get_latents=True)
-        #recons = ema_vae.decoder.out_net.sample(px_z)
-        batch_latent = []
-        for i in range(31):
-            batch_latent.append(stats[i]['z'].cpu().numpy().reshape(len(data_input),-1))
-        test_latents.append(np.hstack(batch_latent))
-        #stats_all.append(stats)
-        #imshow(imgrid(recons, cols=batch_size,pad=20))
-        #imshow(imgrid(test_images[i*batch_size : (i+1)*batch_size], cols=batch_size,pad=20))
-test_latents = np.concatenate(test_latents)      
-
-pred_latents = np.load('data/predicted_features/subj{:02d}/nsd_vdvae_nsdgeneral_pred_sub{}_31l_alpha50k.npy'.format(sub,sub))
-ref_latent = stats
-
-# Transfor latents from flattened representation to hierarchical
-def latent_transformation(latents, ref):
-  layer_dims = np.array([2**4,2**4,2**8,2**8,2**8,2**8,2**10,2**10,2**10,2**10,2**10,2**10,2**10,2**10,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**12,2**14])
-  transformed_latents = []
-  for i in range(31):
-    t_lat = latents[:,layer_dims[:i].sum():layer_dims[:i+1].sum()]
-    #std_norm_test_latent = (t_lat - np.mean(t_lat,axis=0)) / np.std(t_lat,axis=0)
-    #renorm_test_latent = std_norm_test_latent * np.std(kamitani_latents[i][num_test:].reshape(num_train,-1),axis=0) + np.mean(kamitani_latents[i][num_test:].reshape(num_train,-1),axis=0)
-    c,h,w=ref[i]['z'].shape[1:]
-    transformed_latents.append(t_lat.reshape(len(latents),c,h,w))
-  return transformed_latents
-
-idx = range(len(test_images))
-input_latent = latent_transformation(pred_latents[idx],ref_latent)
-
-  
-def sample_from_hier_latents(latents,sample_ids):
-  sample_ids = [id for id in sample_ids if id<len(latents[0])]
-  layers_num=len(latents)
-  sample_latents = []
-  for i in range(layers_num):
-    sample_latents.append(torch.tensor(latents[i][sample_ids]).float().cuda())
-  return sample_latents
+# Latents stay in the flat regression layout (float32, pinned) and each
+# batch is copied to the GPU as a single contiguous buffer; the decoder
+# splits it into per-layer views using its latent layout, whose shapes are
+# derived from the architecture so no encoder pass is needed
+pred_latents = torch.from_numpy(np.ascontiguousarray(pred_latents, dtype=np.float32)).pin_memory()
+latent_layout = ema_vae.decoder.latent_layout[:ema_vae.decoder.latent_layout.num_layers_for(pred_latents.shape[1])]
+if args.decoder != 'default':
+  inference_decoder = build_inference_decoder(ema_vae.decoder, args.decoder)
+  # The inference decoder takes log(t); -inf gives the prior mean
+  log_temperature = 0. if temperature is None else float(np.log(temperature)) if temperature > 0 else float('-inf')
 
 #samples = []
 
-for i in range(int(np.ceil(len(test_images)/batch_size))):
+writer = ImageWriter(max_pending=2*batch_size)
+for i in range(int(np.ceil(len(pred_latents)/batch_size))):
   print(i*batch_size)
-  samp = sample_from_hier_latents(input_latent,range(i*batch_size,(i+1)*batch_size))
-  px_z = ema_vae.decoder.forward_manual_latents(len(samp[0]), samp, t=None)
-  sample_from_latent = ema_vae.decoder.out_net.sample(px_z)
-  upsampled_images = []
-  for j in range(len(sample_from_latent)):
-      im = sample_from_latent[j]
-      im = Image.fromarray(im)
-      im = im.resize((512,512),resample=3)
-      im.save('results/vdvae/subj{:02d}/{}.png'.format(sub,i*batch_size+j))
-      
-
+  samp = pred_latents[i*batch_size:(i+1)*batch_size].cuda(non_blocking=True).to(getattr(torch, args.precision))
+  if ensemble:
+    px_z = ema_vae.decoder.forward_ensemble(samp, num_samples, temperatures).flatten(0, 2)
+  elif args.decoder == 'default':
+    px_z = ema_vae.decoder.forward_manual_latents(len(samp), samp, t=temperature)
+  else:
+    with torch.no_grad():
+      px_z = inference_decoder(latent_layout.split(samp), len(samp), log_temperature)
+  sample_from_latent = ema_vae.decoder.out_net.sample(px_z, to_numpy=False, mode=args.mode)
+  # The whole batch is upsampled on the GPU and PNG encoding runs on
+  # background threads while the next batch is decoded
+  upsampled_images = resize_bicubic(sample_from_latent, 512).cpu().numpy()
+  if ensemble:
+    temps = temperatures or [1.0]
+    upsampled_images = upsampled_images.reshape((len(samp), len(temps), num_samples) + upsampled_images.shape[1:])
+    for j in range(len(samp)):
+      for ti, t in enumerate(temps):
+        for k in range(num_samples):
+          writer.save(upsampled_images[j, ti, k], 'results/vdvae/subj{:02d}/{}_t{}_{}.png'.format(sub,i*batch_size+j,t,k))
+    continue
+  for j in range(len(upsampled_images)):
+      writer.save(upsampled_images[j], 'results/vdvae/subj{:02d}/{}.png'.format(sub,i*batch_size+j))
+
+writer.close()
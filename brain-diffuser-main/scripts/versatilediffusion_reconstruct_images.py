@@ -17,6 +17,7 @@ from lib.experiments.sd_default import color_adjust, auto_merge_imlist
 from torch.utils.data import DataLoader, Dataset
 
 from lib.model_zoo.vd import VD
+from lib.model_zoo.vd_checkpoint import load_vd_model
 from lib.cfg_holder import cfg_unique_holder as cfguh
 from lib.cfg_helper import get_command_line_args, cfg_initiates, load_cfg_yaml
 import matplotlib.pyplot as plt
@@ -27,11 +28,22 @@ parser = argparse.ArgumentParser(description='Argument Parser')
 parser.add_argument("-sub", "--sub",help="Subject Number",default=1)
 parser.add_argument("-diff_str", "--diff_str",help="Diffusion Strength",default=0.75)
 parser.add_argument("-mix_str", "--mix_str",help="Mixing Strength",default=0.4)
+parser.add_argument("-bs", "--bs",help="Number of images reconstructed per DDIM trajectory",default=1)
+parser.add_argument("-seed", "--seed",help="Base seed, image i draws its noise from seed+i",default=0)
+parser.add_argument("-precision", "--precision",help="Precision of the diffusion model and autokl: float32, bfloat16 (use on CPU) or float16",default='float16')
+parser.add_argument("-clip_precision", "--clip_precision",help="Precision of CLIP: float32, bfloat16 or float16",default='float32')
+parser.add_argument("-autocast", "--autocast",help="Keep float32 weights and run the models under autocast in the given precision",action='store_true')
+parser.add_argument("-devices", "--devices",help="Devices of CLIP/autokl and of the diffusion model, comma separated ('cpu' for both on CPU)",default='cuda:0,cuda:1')
 args = parser.parse_args()
 sub=int(args.sub)
 assert sub in [1,2,5,7]
 strength = float(args.diff_str)
 mixing = float(args.mix_str)
+batch_size = int(args.bs)
+seed = int(args.seed)
+devices = args.devices.split(',')
+# CLIP and autokl run on the first device, the diffusion model on the last one
+device, unet_device = devices[0], devices[-1]
 
 
 def regularize_image(x):
@@ -54,30 +66,30 @@ def regularize_image(x):
             'Wrong image size'
         return x
 
-cfgm_name = 'vd_noema'
+cfgm_name = 'vd_noema_image'
 sampler = DDIMSampler_VD
 pth = 'versatile_diffusion/pretrained/vd-four-flow-v1-0-fp16-deprecated.pth'
 cfgm = model_cfg_bank()(cfgm_name)
-net = get_model()(cfgm)
-sd = torch.load(pth, map_location='cpu')
-net.load_state_dict(sd, strict=False)    
+# Set before loading so mapped float16 weights are not cast to float32 and back
+cfgm.args.precision, cfgm.args.autocast = args.precision, args.autocast
+cfgm.args.clip_precision = args.clip_precision
+net = load_vd_model(cfgm, pth)
 
 
 # Might require editing the GPU assignments due to Memory issues
-net.clip.cuda(0)
-net.autokl.cuda(0)
+net.clip.to(device)
+net.autokl.to(device)
+# Before the sampler makes its schedule, which goes to the diffusion model's device
+net.model.diffusion_model.device = unet_device
+net.model.diffusion_model.to(unet_device)
 
-#net.model.cuda(1)
 sampler = sampler(net)
-#sampler.model.model.cuda(1)
-#sampler.model.cuda(1)
-batch_size = 1
 
 pred_text = np.load('data/predicted_features/subj{:02d}/nsd_cliptext_predtest_nsdgeneral.npy'.format(sub))
-pred_text = torch.tensor(pred_text).half().cuda(1)
+pred_text = torch.tensor(pred_text).to(unet_device)
 
 pred_vision = np.load('data/predicted_features/subj{:02d}/nsd_clipvision_predtest_nsdgeneral.npy'.format(sub))
-pred_vision = torch.tensor(pred_vision).half().cuda(1)
+pred_vision = torch.tensor(pred_vision).to(unet_device)
 
 
 n_samples = 1
@@ -86,54 +98,61 @@ ddim_eta = 0
 scale = 7.5
 xtype = 'image'
 ctype = 'prompt'
-net.autokl.half()
 
-torch.manual_seed(0)
-for im_id in range(len(pred_vision)):
+# Schedule and unconditional embeddings are the same for every image
+sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=ddim_eta, verbose=False)
+#strength=0.75
+assert 0. <= strength <= 1., 'can only work with strength in [0.0, 1.0]'
+t_enc = int(strength * ddim_steps)
 
-    zim = Image.open('results/vdvae/subj{:02d}/{}.png'.format(sub,im_id))
-   
-    zim = regularize_image(zim)
-    zin = zim*2 - 1
-    zin = zin.unsqueeze(0).cuda(0).half()
+utx = net.clip_encode_null('prompt')
+utx = utx.to(unet_device)
 
-    init_latent = net.autokl_encode(zin)
-    
-    sampler.make_schedule(ddim_num_steps=ddim_steps, ddim_eta=ddim_eta, verbose=False)
-    #strength=0.75
-    assert 0. <= strength <= 1., 'can only work with strength in [0.0, 1.0]'
-    t_enc = int(strength * ddim_steps)
-    device = 'cuda:0'
-    z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc]).to(device))
-    #z_enc,_ = sampler.encode(init_latent.cuda(1).half(), c.cuda(1).half(), torch.tensor([t_enc]).to(sampler.model.model.diffusion_model.device))
-
-    dummy = ''
-    utx = net.clip_encode_text(dummy)
-    utx = utx.cuda(1).half()
-    
-    dummy = torch.zeros((1,3,224,224)).cuda(0)
-    uim = net.clip_encode_vision(dummy)
-    uim = uim.cuda(1).half()
-    
-    z_enc = z_enc.cuda(1)
+uim = net.clip_encode_null('vision')
+uim = uim.to(unet_device)
 
-    h, w = 512,512
-    shape = [n_samples, 4, h//8, w//8]
+h, w = 512,512
+shape = [n_samples, 4, h//8, w//8]
+latent_dtype = net.model.diffusion_model.dtype
+
+
+def sample_noise(im_id):
+    """
+    Noise of the autokl posterior sample and of the stochastic encoding
+    for one image, drawn from its own generator so that an image gets the
+    same noise whatever the batch it is reconstructed in.
+    """
+    generator = torch.Generator().manual_seed(seed + im_id)
+    posterior_noise = torch.randn(shape, generator=generator)
+    encode_noise = torch.randn(shape, generator=generator)
+    return posterior_noise, encode_noise
+
+
+for batch_start in range(0, len(pred_vision), batch_size):
+    im_ids = list(range(batch_start, min(batch_start + batch_size, len(pred_vision))))
+    n = len(im_ids)
+
+    zim = [regularize_image(Image.open('results/vdvae/subj{:02d}/{}.png'.format(sub,im_id))) for im_id in im_ids]
+    zin = torch.stack(zim)*2 - 1
+    zin = zin.to(device)
+
+    # Drawn in float32 and cast once, float32 noise would upcast half precision latents
+    noise = [sample_noise(im_id) for im_id in im_ids]
+    posterior_noise = torch.cat([pn for pn, _ in noise]).to(device, latent_dtype)
+    encode_noise = torch.cat([en for _, en in noise]).to(device, latent_dtype)
+
+    init_latent = net.autokl_encode(zin, noise=posterior_noise).to(latent_dtype)
+    z_enc = sampler.stochastic_encode(init_latent, torch.tensor([t_enc] * n).to(device), noise=encode_noise)
+    z_enc = z_enc.to(unet_device)
+
+    # Conditionings of the batch stacked along the first axis, unconditional ones repeated to match
+    cim = pred_vision[im_ids]
+    ctx = pred_text[im_ids]
 
-    cim = pred_vision[im_id].unsqueeze(0)
-    ctx = pred_text[im_id].unsqueeze(0)
-    
-    #c[:,0] = u[:,0]
-    #z_enc = z_enc.cuda(1).half()
-    
-    sampler.model.model.diffusion_model.device='cuda:1'
-    sampler.model.model.diffusion_model.half().cuda(1)
-    #mixing = 0.4
-    
     z = sampler.decode_dc(
         x_latent=z_enc,
-        first_conditioning=[uim, cim],
-        second_conditioning=[utx, ctx],
+        first_conditioning=[uim.expand(n, -1, -1), cim],
+        second_conditioning=[utx.expand(n, -1, -1), ctx],
         t_start=t_enc,
         unconditional_guidance_scale=scale,
         xtype='image', 
@@ -141,7 +160,7 @@ for im_id in range(len(pred_vision)):
         second_ctype='prompt',
         mixed_ratio=(1-mixing), )
     
-    z = z.cuda(0).half()
+    z = z.to(device)
     x = net.autokl_decode(z)
     color_adj='None'
     #color_adj_to = cin[0]
@@ -160,7 +179,6 @@ for im_id in range(len(pred_vision)):
         x = torch.clamp((x+1.0)/2.0, min=0.0, max=1.0)
         x = [tvtrans.ToPILImage()(xi) for xi in x]
     
-
-    x[0].save('results/versatile_diffusion/subj{:02d}/{}.png'.format(sub,im_id))
+    for im_id, xi in zip(im_ids, x):
+        xi.save('results/versatile_diffusion/subj{:02d}/{}.png'.format(sub,im_id))
       
-
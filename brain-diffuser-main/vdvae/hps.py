@@ -128,6 +128,8 @@ def add_vae_arguments(parser):
 
     parser.add_argument('--no_bias_above', type=int, default=64)
     parser.add_argument('--scale_encblock', action="store_true")
+    parser.add_argument('--inference_blocks', action="store_true")
+    parser.add_argument('--inference_dtype', type=str, default=None)
 
     parser.add_argument('--test_eval', action="store_true")
     parser.add_argument('--warmup_iters', type=float, default=0)
@@ -2,8 +2,12 @@ import io
 import IPython.display
 import PIL.Image
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pprint import pformat
 import numpy as np
+import torch
 
 def imgrid(imarray, cols=4, pad=1, padval=255, row_major=True):
   """Lays out a [N, H, W, C] image array as a single image grid."""
@@ -66,3 +70,93 @@ def image_to_uint8(x):
   x = np.clip(x, 0, 255)
   x = x.astype(np.uint8)
   return x
+
+
+def _cubic(x, a=-0.5):
+  x = np.abs(x)
+  return np.where(x < 1., ((a + 2.) * x - (a + 3.)) * x * x + 1.,
+                  np.where(x < 2., (((x - 5.) * x + 8.) * x - 4.) * a, 0.))
+
+@lru_cache(maxsize=None)
+def bicubic_weights(in_size, out_size):
+  """
+  (out_size, in_size) matrix of PIL's bicubic resampling coefficients
+  along one axis, including its support widening when downsampling and
+  its renormalisation at the borders.
+  """
+  scale = in_size / out_size
+  filterscale = max(scale, 1.)
+  support = 2. * filterscale
+  weights = np.zeros((out_size, in_size))
+  for i in range(out_size):
+    center = (i + 0.5) * scale
+    xmin = max(int(center - support + 0.5), 0)
+    xmax = min(int(center + support + 0.5), in_size)
+    w = _cubic((np.arange(xmin, xmax) - center + 0.5) / filterscale)
+    weights[i, xmin:xmax] = w / w.sum()
+  return weights
+
+def resize_bicubic(images, size):
+  """
+  Resizes a [N, H, W, C] uint8 batch to size x size like
+  PIL.Image.resize(..., resample=3) does per image (horizontal then
+  vertical pass, each rounded to uint8). Torch tensors are resized on
+  their own device, numpy arrays on the CPU; the type is preserved.
+  Pixels can differ from PIL by one level due to its fixed point weights.
+  """
+  N, H, W, C = images.shape
+  if torch.is_tensor(images):
+    w = torch.as_tensor(bicubic_weights(W, size), dtype=torch.float32, device=images.device)
+    h = torch.as_tensor(bicubic_weights(H, size), dtype=torch.float32, device=images.device)
+    x = torch.einsum('nhwc,ow->nhoc', images.float(), w).add_(0.5).floor_().clamp_(0., 255.)
+    x = torch.einsum('nhwc,oh->nowc', x, h).add_(0.5).floor_().clamp_(0., 255.)
+    return x.to(torch.uint8)
+  w = bicubic_weights(W, size).astype(np.float32)
+  h = bicubic_weights(H, size).astype(np.float32)
+  x = np.clip(np.floor(np.einsum('nhwc,ow->nhoc', images.astype(np.float32), w) + 0.5), 0., 255.)
+  x = np.clip(np.floor(np.einsum('nhwc,oh->nowc', x, h) + 0.5), 0., 255.)
+  return x.astype(np.uint8)
+
+class ImageWriter(object):
+  """
+  Saves [H, W, C] uint8 arrays as image files on background threads, so
+  the decoder does not wait on PNG compression. At most max_pending
+  images are queued; save() blocks beyond that to bound memory. Errors
+  raised while writing are re-raised by a later save() or by close().
+  """
+  def __init__(self, num_workers=4, max_pending=64):
+    self.pool = ThreadPoolExecutor(max_workers=num_workers)
+    self.slots = threading.BoundedSemaphore(max_pending)
+    self.futures = []
+
+  def _write(self, im, path):
+    try:
+      PIL.Image.fromarray(im).save(path)
+    finally:
+      self.slots.release()
+
+  def _check(self, wait=False):
+    pending = []
+    for future in self.futures:
+      if wait or future.done():
+        future.result()
+      else:
+        pending.append(future)
+    self.futures = pending
+
+  def save(self, im, path):
+    self._check()
+    self.slots.acquire()
+    self.futures.append(self.pool.submit(self._write, np.ascontiguousarray(im), path))
+
+  def close(self):
+    try:
+      self._check(wait=True)
+    finally:
+      self.pool.shutdown()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
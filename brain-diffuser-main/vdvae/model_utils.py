@@ -17,6 +17,7 @@ from contextlib import contextmanager
 import torch.distributed as dist
 #from apex.optimizers import FusedAdam as AdamW
 from vae import VAE
+from vae_inference import prepare_for_inference, load_inference_vae, inference_checkpoint_path
 from torch.nn.parallel.distributed import DistributedDataParallel
 from train_helpers import restore_params
 
@@ -81,6 +82,11 @@ def set_up_data(H):
 
 def load_vaes(H, logprint=None):
 
+    # An inference checkpoint converted with scripts/convert_vdvae_checkpoint.py is mapped directly
+    if H.restore_ema_path and os.path.isdir(inference_checkpoint_path(H.restore_ema_path)):
+        print(f'Restoring ema vae from {inference_checkpoint_path(H.restore_ema_path)}')
+        return load_inference_vae(H, inference_checkpoint_path(H.restore_ema_path), device=torch.device('cuda', H.local_rank))
+
     ema_vae = VAE(H)
     if H.restore_ema_path:
         print(f'Restoring ema vae from {H.restore_ema_path}')
@@ -89,6 +95,7 @@ def load_vaes(H, logprint=None):
         ema_vae.load_state_dict(vae.state_dict())
     ema_vae.requires_grad_(False)
     ema_vae = ema_vae.cuda(H.local_rank)
+    ema_vae = prepare_for_inference(ema_vae, H)
 
     #vae = DistributedDataParallel(vae, device_ids=[H.local_rank], output_device=H.local_rank)
 
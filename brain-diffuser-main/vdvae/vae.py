@@ -28,6 +28,29 @@ class Block(nn.Module):
         return out
 
 
+class InferenceBlock(Block):
+    """
+    Block with the same parameters but an inference oriented forward. The
+    1x1 convs c1 and c4 run as one GEMM over channels with the bias fused
+    in (F.linear), which needs no layout copies on channels_last inputs,
+    and the residual is added in place. Selected with H.inference_blocks,
+    see prepare_for_inference for the matching memory format and precision setup.
+    """
+    def forward(self, x):
+        xhat = F.linear(F.gelu(x).permute(0, 2, 3, 1), self.c1.weight.flatten(1), self.c1.bias).permute(0, 3, 1, 2)
+        xhat = self.c2(F.gelu(xhat))
+        xhat = self.c3(F.gelu(xhat))
+        xhat = F.linear(F.gelu(xhat).permute(0, 2, 3, 1), self.c4.weight.flatten(1), self.c4.bias).permute(0, 3, 1, 2)
+        out = xhat.add_(x) if self.residual else xhat
+        if self.down_rate is not None:
+            out = F.avg_pool2d(out, kernel_size=self.down_rate, stride=self.down_rate)
+        return out
+
+
+def get_block_class(H):
+    return InferenceBlock if H.inference_blocks else Block
+
+
 def parse_layer_string(s):
     layers = []
     for ss in s.split(','):
@@ -47,11 +70,52 @@ def parse_layer_string(s):
     return layers
 
 
+class LatentLayout(object):
+    """
+    Shapes (c, h, w) of the decoder block latents and their offsets in the
+    flat (n, total) layout used for regression. Derived from H.dec_blocks
+    and H.zdim, so no encoder pass is needed to recover the hierarchy.
+    """
+    def __init__(self, shapes):
+        self.shapes = [tuple(int(d) for d in shape) for shape in shapes]
+        self.sizes = [int(np.prod(shape)) for shape in self.shapes]
+        self.offsets = [int(o) for o in np.cumsum([0] + self.sizes)]
+        self.total = self.offsets[-1]
+
+    @classmethod
+    def from_hparams(cls, H, num_layers=None):
+        blocks = parse_layer_string(H.dec_blocks)[:num_layers]
+        return cls([(H.zdim, res, res) for res, _ in blocks])
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, idx):
+        assert isinstance(idx, slice), 'Index the layout with a slice, e.g. layout[:31]'
+        return LatentLayout(self.shapes[idx])
+
+    def num_layers_for(self, total):
+        """Number of leading layers whose latents add up to total flat dims."""
+        assert total in self.offsets, '{} latent dims do not match a prefix of the layout'.format(total)
+        return self.offsets.index(total)
+
+    def split(self, flat):
+        """
+        Splits a flat (n, total) numpy array or tensor into per-layer
+        (n, c, h, w) latents. These are views into flat, no data is copied.
+        """
+        assert flat.shape[1] == self.total, 'Expected {} latent dims, got {}'.format(self.total, flat.shape[1])
+        n = flat.shape[0]
+        if torch.is_tensor(flat):
+            return [flat.narrow(1, start, size).view((n,) + shape)
+                    for start, size, shape in zip(self.offsets, self.sizes, self.shapes)]
+        return [flat[:, start:start + size].reshape((n,) + shape)
+                for start, size, shape in zip(self.offsets, self.sizes, self.shapes)]
+
+
 def pad_channels(t, width):
-    d1, d2, d3, d4 = t.shape
-    empty = torch.zeros(d1, width, d3, d4, device=t.device)
-    empty[:, :d2, :, :] = t
-    return empty
+    # Zero pads the channels in one op, keeping the dtype of t
+    return F.pad(t, (0, 0, 0, 0, 0, width - t.shape[1]))
 
 
 def get_width_settings(width, s):
@@ -70,10 +134,11 @@ class Encoder(HModule):
         self.in_conv = get_3x3(H.image_channels, H.width)
         self.widths = get_width_settings(H.width, H.custom_width_str)
         enc_blocks = []
+        block_cls = get_block_class(H)
         blockstr = parse_layer_string(H.enc_blocks)
         for res, down_rate in blockstr:
             use_3x3 = res > 2  # Don't use 3x3s for 1x1, 2x2 patches
-            enc_blocks.append(Block(self.widths[res], int(self.widths[res] * H.bottleneck_multiple), self.widths[res], down_rate=down_rate, residual=True, use_3x3=use_3x3))
+            enc_blocks.append(block_cls(self.widths[res], int(self.widths[res] * H.bottleneck_multiple), self.widths[res], down_rate=down_rate, residual=True, use_3x3=use_3x3))
         n_blocks = len(blockstr)
         for b in enc_blocks:
             b.c4.weight.data *= np.sqrt(1 / n_blocks)
@@ -103,11 +168,12 @@ class DecBlock(nn.Module):
         use_3x3 = res > 2
         cond_width = int(width * H.bottleneck_multiple)
         self.zdim = H.zdim
-        self.enc = Block(width * 2, cond_width, H.zdim * 2, residual=False, use_3x3=use_3x3)
-        self.prior = Block(width, cond_width, H.zdim * 2 + width, residual=False, use_3x3=use_3x3, zero_last=True)
+        block_cls = get_block_class(H)
+        self.enc = block_cls(width * 2, cond_width, H.zdim * 2, residual=False, use_3x3=use_3x3)
+        self.prior = block_cls(width, cond_width, H.zdim * 2 + width, residual=False, use_3x3=use_3x3, zero_last=True)
         self.z_proj = get_1x1(H.zdim, width)
         self.z_proj.weight.data *= np.sqrt(1 / n_blocks)
-        self.resnet = Block(width, cond_width, width, residual=True, use_3x3=use_3x3)
+        self.resnet = block_cls(width, cond_width, width, residual=True, use_3x3=use_3x3)
         self.resnet.c4.weight.data *= np.sqrt(1 / n_blocks)
         self.z_fn = lambda x: self.z_proj(x)
 
@@ -128,9 +194,13 @@ class DecBlock(nn.Module):
         if lvs is not None:
             z = lvs
         else:
-            if t is not None:
+            if torch.is_tensor(t):
+                # one temperature per sample, zero gives the prior mean
+                pv = pv + torch.log(t).to(pv.dtype).view(-1, 1, 1, 1)
+            elif t is not None and t > 0:
                 pv = pv + torch.ones_like(pv) * np.log(t)
-            z = draw_gaussian_diag_samples(pm, pv)
+            # Temperature zero takes the prior mean
+            z = pm if t is not None and not torch.is_tensor(t) and t == 0 else draw_gaussian_diag_samples(pm, pv)
         return z, x
 
     def get_inputs(self, xs, activations):
@@ -183,43 +253,108 @@ class Decoder(HModule):
             resos.add(res)
         self.resolutions = sorted(resos)
         self.dec_blocks = nn.ModuleList(dec_blocks)
+        self.latent_layout = LatentLayout.from_hparams(H)
+        # Liveness of the per-resolution activations: after block idx the
+        # decoder drops the xs entries in free_xs_after[idx] (no later block
+        # reads them as base or mixin) and, when asked, the encoder
+        # activations in free_acts_after[idx]
+        last_xs_use, last_acts_use = {}, {}
+        for idx, (res, mixin) in enumerate(blocks):
+            last_xs_use[res] = last_acts_use[res] = idx
+            if mixin is not None:
+                last_xs_use[mixin] = idx
+        self.free_xs_after = [[res for res, last in last_xs_use.items() if last == idx and res != H.image_size] for idx in range(len(blocks))]
+        self.free_acts_after = [[res for res, last in last_acts_use.items() if last == idx] for idx in range(len(blocks))]
         self.bias_xs = nn.ParameterList([nn.Parameter(torch.zeros(1, self.widths[res], res, res)) for res in self.resolutions if res <= H.no_bias_above])
         self.out_net = DmolNet(H)
         self.gain = nn.Parameter(torch.ones(1, H.width, 1, 1))
         self.bias = nn.Parameter(torch.zeros(1, H.width, 1, 1))
         self.final_fn = lambda x: x * self.gain + self.bias
 
-    def forward(self, activations, get_latents=False):
+    def forward(self, activations, get_latents=False, latent_callback=None, release_activations=False, num_blocks=None):
+        """
+        With latent_callback, each block's stats dict (z and kl) is passed
+        to latent_callback(idx, block_stats) as soon as it is computed and
+        no stats are kept. With release_activations, encoder activations
+        are deleted from the activations dict after their last use. With
+        num_blocks only the first blocks run, e.g. to extract their
+        latents, and px_z is None.
+        """
         stats = []
         xs = {a.shape[2]: a for a in self.bias_xs}
-        for block in self.dec_blocks:
-            xs, block_stats = block(xs, activations, get_latents=get_latents)
-            stats.append(block_stats)
+        for idx, block in enumerate(self.dec_blocks[:num_blocks]):
+            xs, block_stats = block(xs, activations, get_latents=get_latents or latent_callback is not None)
+            if latent_callback is not None:
+                latent_callback(idx, block_stats)
+            else:
+                stats.append(block_stats)
+            self.free_after(idx, xs, activations if release_activations else None)
+        if num_blocks is not None and num_blocks < len(self.dec_blocks):
+            return None, stats
         xs[self.H.image_size] = self.final_fn(xs[self.H.image_size])
         return xs[self.H.image_size], stats
 
+    def free_after(self, idx, xs, activations=None):
+        for res in self.free_xs_after[idx]:
+            xs.pop(res, None)
+        if activations is not None:
+            for res in self.free_acts_after[idx]:
+                activations.pop(res, None)
+
+    def initial_xs(self, n):
+        # Biases are broadcast rather than copied, the first block at each
+        # resolution writes a fresh tensor
+        return {bias.shape[2]: bias.expand(n, -1, -1, -1) for bias in self.bias_xs}
+
     def forward_uncond(self, n, t=None, y=None):
-        xs = {}
-        for bias in self.bias_xs:
-            xs[bias.shape[2]] = bias.repeat(n, 1, 1, 1)
+        xs = self.initial_xs(n)
         for idx, block in enumerate(self.dec_blocks):
-            try:
-                temp = t[idx]
-            except TypeError:
-                temp = t
+            # t is one temperature, a per-sample tensor or a per-layer sequence
+            temp = t[idx] if isinstance(t, (list, tuple, np.ndarray)) else t
             xs = block.forward_uncond(xs, temp)
+            self.free_after(idx, xs)
         xs[self.H.image_size] = self.final_fn(xs[self.H.image_size])
         return xs[self.H.image_size]
 
     def forward_manual_latents(self, n, latents, t=None):
-        xs = {}
-        for bias in self.bias_xs:
-            xs[bias.shape[2]] = bias.repeat(n, 1, 1, 1)
-        for block, lvs in itertools.zip_longest(self.dec_blocks, latents):
+        """
+        latents is either a list of per-layer (n, c, h, w) tensors or a
+        single flat (n, total) tensor in the regression layout, which is
+        split into per-layer views. Layers without latents are sampled with
+        temperature t, a float or a (n,) tensor of per-sample temperatures.
+        """
+        latents = self.split_latents(latents)
+        xs = self.initial_xs(n)
+        for idx, (block, lvs) in enumerate(itertools.zip_longest(self.dec_blocks, latents)):
             xs = block.forward_uncond(xs, t, lvs=lvs)
+            self.free_after(idx, xs)
         xs[self.H.image_size] = self.final_fn(xs[self.H.image_size])
         return xs[self.H.image_size]
 
+    def forward_ensemble(self, latents, num_samples=1, temperatures=None):
+        """
+        Decodes num_samples reconstructions at each of the temperatures
+        from every one of the n latents (flat or per-layer) in a single
+        batched pass, sampling the layers without latents. With
+        temperatures=None the prior is sampled at its own scale. Returns
+        px_z of shape (n, len(temperatures), num_samples, c, h, w).
+        """
+        latents = self.split_latents(latents)
+        temps = [None] if temperatures is None else list(temperatures)
+        n, copies = latents[0].shape[0], len(temps) * num_samples
+        latents = [lvs.repeat_interleave(copies, dim=0) for lvs in latents]
+        t = None
+        if temperatures is not None:
+            t = torch.tensor(temps, device=latents[0].device).repeat_interleave(num_samples).repeat(n)
+        px_z = self.forward_manual_latents(n * copies, latents, t=t)
+        return px_z.view((n, len(temps), num_samples) + tuple(px_z.shape[1:]))
+
+    def split_latents(self, latents):
+        if torch.is_tensor(latents):
+            layout = self.latent_layout[:self.latent_layout.num_layers_for(latents.shape[1])]
+            return layout.split(latents)
+        return latents
+
 
 class VAE(HModule):
     def build(self):
@@ -250,3 +385,9 @@ class VAE(HModule):
     def forward_samples_set_latents(self, n_batch, latents, t=None):
         px_z = self.decoder.forward_manual_latents(n_batch, latents, t=t)
         return self.decoder.out_net.sample(px_z)
+
+    def forward_ensemble_samples(self, latents, num_samples=1, temperatures=None, mode='sample'):
+        """uint8 images of shape (n, len(temperatures), num_samples, h, w, 3), see Decoder.forward_ensemble."""
+        px_z = self.decoder.forward_ensemble(latents, num_samples, temperatures)
+        images = self.decoder.out_net.sample(px_z.flatten(0, 2), mode=mode)
+        return images.reshape(px_z.shape[:3] + images.shape[1:])
@@ -136,6 +136,24 @@ def sample_from_discretized_mix_logistic(l, nr_mix):
     return torch.cat([torch.reshape(x0, xs[:-1] + [1]), torch.reshape(x1, xs[:-1] + [1]), torch.reshape(x2, xs[:-1] + [1])], dim=3)
 
 
+def mean_from_discretized_mix_logistic(l, nr_mix):
+    """
+    Deterministic counterpart of sample_from_discretized_mix_logistic: takes
+    the most likely mixture component and its mean instead of sampling both.
+    The selected parameters are gathered straight from l, so no one-hot
+    selector or full-size noise tensors are allocated.
+    """
+    # per pixel the channels of l are [logits, (means, log_scales, coeffs) for each of rgb]
+    amax = torch.argmax(l[:, :, :, :nr_mix], dim=3, keepdim=True)
+    offsets = torch.tensor([nr_mix, 4 * nr_mix, 7 * nr_mix, 3 * nr_mix, 6 * nr_mix, 9 * nr_mix], device=l.device)
+    params = torch.gather(l, 3, amax + offsets)
+    means, coeffs = params[:, :, :, :3], torch.tanh(params[:, :, :, 3:])
+    x0 = means[:, :, :, 0].clamp(-1., 1.)
+    x1 = (means[:, :, :, 1] + coeffs[:, :, :, 0] * x0).clamp_(-1., 1.)
+    x2 = (means[:, :, :, 2] + coeffs[:, :, :, 1] * x0 + coeffs[:, :, :, 2] * x1).clamp_(-1., 1.)
+    return torch.stack([x0, x1, x2], dim=3)
+
+
 class HModule(nn.Module):
     def __init__(self, H):
         super().__init__()
@@ -157,9 +175,21 @@ class DmolNet(nn.Module):
         xhat = self.out_conv(px_z)
         return xhat.permute(0, 2, 3, 1)
 
-    def sample(self, px_z):
-        im = sample_from_discretized_mix_logistic(self.forward(px_z), self.H.num_mixtures)
-        xhat = (im + 1.0) * 127.5
-        xhat = xhat.detach().cpu().numpy()
-        xhat = np.minimum(np.maximum(0.0, xhat), 255.0).astype(np.uint8)
+    def sample(self, px_z, to_numpy=True, mode='sample'):
+        """
+        Samples uint8 (n, h, w, 3) images. mode='mean' instead returns the
+        mean of the most likely mixture component, which is deterministic
+        and cheaper. With to_numpy=False the images are returned as a
+        tensor on the device of px_z, e.g. to post-process the batch there
+        before a single transfer.
+        """
+        assert mode in ['sample', 'mean']
+        px_z = px_z.to(self.out_conv.weight.dtype)
+        if mode == 'mean':
+            im = mean_from_discretized_mix_logistic(self.forward(px_z), self.H.num_mixtures)
+        else:
+            im = sample_from_discretized_mix_logistic(self.forward(px_z), self.H.num_mixtures)
+        xhat = ((im + 1.0) * 127.5).clamp_(0.0, 255.0).to(torch.uint8).detach()
+        if to_numpy:
+            return xhat.cpu().numpy()
         return xhat
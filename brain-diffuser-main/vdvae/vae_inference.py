@@ -0,0 +1,195 @@
+import os
+import json
+import inspect
+from typing import List
+
+import numpy as np
+import torch
+from torch import nn
+from torch.nn import functional as F
+from vae import VAE
+from vae_helpers import draw_gaussian_diag_samples
+
+CHECKPOINT_HEADER = 'header.json'
+CHECKPOINT_WEIGHTS = 'weights.npy'
+CHECKPOINT_FORMAT_VERSION = 1
+
+
+class InferenceDecBlock(nn.Module):
+    """
+    Prior path of a trained DecBlock (the encoder branch is not needed to
+    decode given latents). Resolutions are addressed by fixed slots in the
+    decoder state list instead of dict keys, so the block can be scripted.
+    """
+    def __init__(self, block, slot, mixin_slot):
+        super().__init__()
+        self.prior = block.prior
+        self.z_proj = block.z_proj
+        self.resnet = block.resnet
+        self.zdim = block.zdim
+        self.slot = slot
+        self.mixin_slot = mixin_slot
+        self.scale = float(block.base // block.mixin) if block.mixin is not None else 1.
+
+    def forward(self, xs: List[torch.Tensor], z: torch.Tensor, has_latent: bool, logt: float) -> List[torch.Tensor]:
+        x = xs[self.slot]
+        if self.mixin_slot >= 0:
+            x = x + F.interpolate(xs[self.mixin_slot][:, :x.shape[1], ...], scale_factor=self.scale)
+        feats = self.prior(x)
+        pm, pv, xpp = feats[:, :self.zdim, ...], feats[:, self.zdim:self.zdim * 2, ...], feats[:, self.zdim * 2:, ...]
+        x = x + xpp
+        if not has_latent:
+            z = draw_gaussian_diag_samples(pm, pv + logt)
+        x = x + self.z_proj(z)
+        xs[self.slot] = self.resnet(x)
+        return xs
+
+
+class InferenceDecoder(nn.Module):
+    """
+    Compile friendly equivalent of Decoder.forward_manual_latents sharing
+    the trained decoder's parameters. The per-resolution activations live
+    in a list with one static slot per resolution, and there are no dict
+    lookups, KeyError fallbacks or lambdas, so the module can be passed to
+    torch.jit.script / torch.jit.trace (or torch.compile where available).
+    Like the Decoder, it frees each slot after its last use.
+    """
+    free_after: List[List[int]]
+
+    def __init__(self, decoder):
+        super().__init__()
+        H = decoder.H
+        self.resolutions = list(decoder.resolutions)
+        self.widths = [decoder.widths[res] for res in self.resolutions]
+        self.image_slot = self.resolutions.index(H.image_size)
+        slot = {res: i for i, res in enumerate(self.resolutions)}
+        self.blocks = nn.ModuleList([InferenceDecBlock(b, slot[b.base], slot[b.mixin] if b.mixin is not None else -1)
+                                     for b in decoder.dec_blocks])
+        # Resolutions without a learned bias start from zeros, as in DecBlock.forward_uncond
+        biases = {b.shape[2]: b for b in decoder.bias_xs}
+        self.bias_xs = nn.ParameterList([biases[res] if res in biases else
+                                         nn.Parameter(decoder.gain.new_zeros(1, self.widths[i], res, res), requires_grad=False)
+                                         for i, res in enumerate(self.resolutions)])
+        self.gain = decoder.gain
+        self.bias = decoder.bias
+        self.free_after = [[slot[res] for res in free] for free in decoder.free_xs_after]
+
+    def forward(self, latents: List[torch.Tensor], n: int, logt: float = 0.) -> torch.Tensor:
+        """
+        Decodes px_z from per-layer latents; blocks past the end of latents
+        are sampled from the prior with log temperature logt.
+        """
+        xs: List[torch.Tensor] = []
+        for bias in self.bias_xs:
+            xs.append(bias.expand(n, -1, -1, -1))
+        num_latents = len(latents)
+        # latents[0] is a placeholder for the sampled blocks and never used there
+        none = latents[0] if num_latents > 0 else xs[0]
+        for i, block in enumerate(self.blocks):
+            if i < num_latents:
+                xs = block(xs, latents[i], True, logt)
+            else:
+                xs = block(xs, none, False, logt)
+            # Slots no later block reads are released
+            for slot in self.free_after[i]:
+                xs[slot] = xs[slot].new_empty(0)
+        return xs[self.image_slot] * self.gain + self.bias
+
+
+def build_inference_decoder(decoder, backend='eager'):
+    """
+    Wraps a trained Decoder in an InferenceDecoder. backend is 'eager',
+    'script' (torch.jit.script) or 'compile' (torch.compile, torch >= 2.0).
+    """
+    assert backend in ['eager', 'script', 'compile']
+    inference_decoder = InferenceDecoder(decoder).eval()
+    if backend == 'script':
+        return torch.jit.script(inference_decoder)
+    if backend == 'compile':
+        assert hasattr(torch, 'compile'), 'torch.compile needs torch >= 2.0, use the script backend instead'
+        return torch.compile(inference_decoder)
+    return inference_decoder
+
+
+def prepare_for_inference(vae, H):
+    """
+    Moves a loaded VAE to the layout and precision selected in H.
+    Inference blocks work best on channels_last tensors. With
+    H.inference_dtype ('float16' or 'bfloat16') the model runs in half
+    precision, except DmolNet whose sampler needs float32.
+    """
+    if H.inference_blocks:
+        vae = vae.to(memory_format=torch.channels_last)
+    if H.inference_dtype:
+        vae = vae.to(getattr(torch, H.inference_dtype))
+        vae.decoder.out_net.float()
+    return vae
+
+
+def inference_checkpoint_path(path):
+    """Directory of the inference checkpoint converted from the torch checkpoint at path."""
+    return os.path.splitext(path)[0] + '-inference'
+
+
+def save_inference_checkpoint(state_dict, out_dir, dtype='float32'):
+    """
+    Writes the tensors of state_dict (DDP 'module.' prefixes stripped) as
+    one flat dtype array in a .npy file plus a JSON index of names,
+    shapes and offsets, so the weights can be memory-mapped at load time.
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in (np.float16, np.float32), 'Unsupported checkpoint dtype {}'.format(dtype)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    tensors, offset = {}, 0
+    for name, tensor in state_dict.items():
+        name = name[len('module.'):] if name.startswith('module.') else name
+        tensors[name] = {'shape': list(tensor.shape), 'offset': offset}
+        offset += tensor.numel()
+    flat = np.lib.format.open_memmap(os.path.join(out_dir, CHECKPOINT_WEIGHTS), mode='w+', dtype=dtype, shape=(offset,))
+    for (name, info), tensor in zip(tensors.items(), state_dict.values()):
+        flat[info['offset']:info['offset'] + tensor.numel()] = tensor.detach().cpu().numpy().ravel()
+    flat.flush()
+    with open(os.path.join(out_dir, CHECKPOINT_HEADER), 'w') as f:
+        json.dump({'format_version': CHECKPOINT_FORMAT_VERSION, 'dtype': dtype.name, 'tensors': tensors}, f, indent=2)
+
+
+def load_inference_state_dict(path):
+    """
+    State dict of tensors viewing the memory-mapped checkpoint at path.
+    The mapping is copy-on-write and pages are only read when used.
+    """
+    with open(os.path.join(path, CHECKPOINT_HEADER), 'r') as f:
+        header = json.load(f)
+    assert header['format_version'] == CHECKPOINT_FORMAT_VERSION, \
+        'Unsupported checkpoint format {}'.format(header['format_version'])
+    flat = torch.from_numpy(np.load(os.path.join(path, CHECKPOINT_WEIGHTS), mmap_mode='c'))
+    state_dict = {}
+    for name, info in header['tensors'].items():
+        numel = int(np.prod(info['shape']))
+        state_dict[name] = flat[info['offset']:info['offset'] + numel].view(info['shape'])
+    return state_dict
+
+
+def load_inference_vae(H, path, device='cpu'):
+    """
+    Builds the VAE and loads an inference checkpoint. Where torch supports
+    it (>= 2.1) the modules are created on the meta device and the mapped
+    tensors assigned to them, so no weights are allocated, initialised and
+    then overwritten; older versions build normally and copy them in.
+    Parameters end up on device, in float32 unless H.inference_dtype is set.
+    """
+    state_dict = load_inference_state_dict(path)
+    dtype = getattr(torch, H.inference_dtype) if H.inference_dtype else torch.float32
+    meta_device = hasattr(torch.device, '__enter__')
+    assign = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+    if meta_device and assign:
+        with torch.device('meta'):
+            vae = VAE(H)
+        vae.load_state_dict(state_dict, assign=True)
+    else:
+        vae = VAE(H)
+        vae.load_state_dict(state_dict)
+    vae.requires_grad_(False)
+    return prepare_for_inference(vae.to(device=device, dtype=dtype), H)
+
@@ -1,4 +1,5 @@
 from inspect import isfunction
+from contextlib import contextmanager
 import math
 import torch
 import torch.nn.functional as F
@@ -77,6 +78,52 @@ def Normalize(in_channels):
     return torch.nn.GroupNorm(num_groups=32, num_channels=in_channels, eps=1e-6, affine=True)
 
 
+#############
+# attention #
+#############
+
+# 'einsum' materialises the full similarity matrix, 'sdpa' uses
+# torch.nn.functional.scaled_dot_product_attention (torch >= 2.0), 'chunked'
+# bounds memory by attending ATTENTION_CHUNK_SIZE queries at a time and
+# 'auto' picks sdpa where available and chunked otherwise.
+ATTENTION_BACKENDS = ['einsum', 'sdpa', 'chunked', 'auto']
+ATTENTION_CHUNK_SIZE = 1024
+
+
+def attention(q, k, v, scale, backend='auto'):
+    """
+    softmax(q k^T * scale) v for (..., n, d) queries and (..., m, d) keys
+    and values, computed by the given backend.
+    """
+    assert backend in ATTENTION_BACKENDS, f'attention backend {backend} unknown'
+    if backend == 'auto':
+        backend = 'sdpa' if hasattr(F, 'scaled_dot_product_attention') else 'chunked'
+    if backend == 'sdpa':
+        assert hasattr(F, 'scaled_dot_product_attention'), 'sdpa attention needs torch >= 2.0'
+        # sdpa scales by d**-0.5, and falls back to its unfused kernel on
+        # inputs whose last dimension is strided (e.g. channel-first maps)
+        if scale != q.shape[-1] ** -0.5:
+            q = q * (scale * q.shape[-1] ** 0.5)
+        q, k, v = q.contiguous(), k.contiguous(), v.contiguous()
+        return F.scaled_dot_product_attention(q, k, v)
+    if backend == 'chunked':
+        out = q.new_empty(q.shape[:-1] + v.shape[-1:])
+        for i in range(0, q.shape[-2], ATTENTION_CHUNK_SIZE):
+            sim = torch.matmul(q[..., i:i+ATTENTION_CHUNK_SIZE, :], k.transpose(-1, -2)) * scale
+            out[..., i:i+ATTENTION_CHUNK_SIZE, :] = torch.matmul(sim.softmax(dim=-1), v)
+        return out
+    sim = torch.matmul(q, k.transpose(-1, -2)) * scale
+    return torch.matmul(sim.softmax(dim=-1), v)
+
+
+def set_attention_backend(model, backend):
+    """Selects the attention backend of every attention layer in model."""
+    assert backend in ATTENTION_BACKENDS, f'attention backend {backend} unknown'
+    for module in model.modules():
+        if hasattr(module, 'attention_backend'):
+            module.attention_backend = backend
+
+
 class LinearAttention(nn.Module):
     def __init__(self, dim, heads=4, dim_head=32):
         super().__init__()
@@ -122,6 +169,7 @@ class SpatialSelfAttention(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        self.attention_backend = 'einsum'
 
     def forward(self, x):
         h_ = x
@@ -132,6 +180,12 @@ class SpatialSelfAttention(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
+        if self.attention_backend != 'einsum':
+            q, k, v = map(lambda t: rearrange(t, 'b c h w -> b (h w) c'), (q, k, v))
+            h_ = attention(q, k, v, int(c)**(-0.5), self.attention_backend)
+            h_ = rearrange(h_, 'b (h w) c -> b c h w', h=h)
+            return x+self.proj_out(h_)
+
         q = rearrange(q, 'b c h w -> b (h w) c')
         k = rearrange(k, 'b c h w -> b c (h w)')
         w_ = torch.einsum('bij,bjk->bik', q, k)
@@ -166,16 +220,39 @@ class CrossAttention(nn.Module):
             nn.Linear(inner_dim, query_dim),
             nn.Dropout(dropout)
         )
+        self.kv_cache = None
+        self.attention_backend = 'einsum'
+
+    def context_kv(self, context):
+        """
+        Keys and values of a cross-attention context, split into heads.
+        Inside cache_context_kv they are computed once per context tensor
+        and reused as long as the same tensor is passed.
+        """
+        if self.kv_cache is not None:
+            for cached_context, k, v in self.kv_cache:
+                if cached_context is context:
+                    return k, v
+        k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=self.heads),
+                   (self.to_k(context), self.to_v(context)))
+        if self.kv_cache is not None:
+            self.kv_cache.append((context, k, v))
+        return k, v
 
     def forward(self, x, context=None, mask=None):
         h = self.heads
 
         q = self.to_q(x)
-        context = default(context, x)
-        k = self.to_k(context)
-        v = self.to_v(context)
+        q = rearrange(q, 'b n (h d) -> (b h) n d', h=h)
+        if context is None:
+            k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (self.to_k(x), self.to_v(x)))
+        else:
+            k, v = self.context_kv(context)
 
-        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> (b h) n d', h=h), (q, k, v))
+        if self.attention_backend != 'einsum' and not exists(mask):
+            out = attention(q, k, v, self.scale, self.attention_backend)
+            out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+            return self.to_out(out)
 
         sim = einsum('b i d, b j d -> b i j', q, k) * self.scale
 
@@ -193,6 +270,24 @@ class CrossAttention(nn.Module):
         return self.to_out(out)
 
 
+@contextmanager
+def cache_context_kv(model):
+    """
+    Within the block the cross-attention layers of model compute the keys
+    and values of each context once, e.g. over all steps of a sampling
+    trajectory where the conditioning stays the same. The caches start
+    empty and are released on exit.
+    """
+    layers = [m for m in model.modules() if isinstance(m, CrossAttention)]
+    for layer in layers:
+        layer.kv_cache = []
+    try:
+        yield
+    finally:
+        for layer in layers:
+            layer.kv_cache = None
+
+
 class BasicTransformerBlock(nn.Module):
     def __init__(self, dim, n_heads, d_head, dropout=0., context_dim=None, gated_ff=True, checkpoint=True,
                  disable_self_attn=False):
@@ -71,6 +71,9 @@ class FrozenCLIP(AbstractEncoder):
         # A trick to get device
         return self.model.text_projection.weight.device
 
+    def get_dtype(self):
+        return self.model.text_projection.weight.dtype
+
     def freeze(self):
         self.model = self.model.eval()
         self.train = disabled_train
@@ -86,8 +89,7 @@ class FrozenCLIP(AbstractEncoder):
 
     def encode_vision_pooled(self, images):
         inputs = self.processor(images=images, return_tensors="pt")
-        pixels = inputs['pixel_values'].half() if self.fp16 else inputs['pixel_values']
-        pixels = pixels.to(self.get_device())
+        pixels = inputs['pixel_values'].to(self.get_device(), self.get_dtype())
         return self.model.get_image_features(pixel_values=pixels)
 
     def encode_text_noproj(self, text):
@@ -99,8 +101,7 @@ class FrozenCLIP(AbstractEncoder):
         
     def encode_vision_noproj(self, images):
         inputs = self.processor(images=images, return_tensors="pt")
-        pixels = inputs['pixel_values'].half() if self.fp16 else inputs['pixel_values']
-        pixels = pixels.to(self.get_device())
+        pixels = inputs['pixel_values'].to(self.get_device(), self.get_dtype())
         outputs = self.model.vision_model(pixel_values=pixels)
         return outputs.last_hidden_state
 
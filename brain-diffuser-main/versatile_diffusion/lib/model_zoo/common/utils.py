@@ -288,5 +288,6 @@ def get_total_param_sum(net):
     if getattr(net, 'parameters', None) is None:
         return 0
     with torch.no_grad():
-        s = sum(p.cpu().detach().numpy().sum().item() for p in net.parameters())
+        # Parameters on the meta device (see vd_checkpoint.init_empty_parameters) have no data yet
+        s = sum(p.cpu().detach().numpy().sum().item() for p in net.parameters() if p.device.type != 'meta')
     return s 
@@ -9,26 +9,56 @@ from .diffusion_utils import make_ddim_sampling_parameters, make_ddim_timesteps,
 
 
 class DDIMSampler(object):
+    schedule_buffers = [
+        'ddim_timesteps', 'betas', 'alphas_cumprod', 'alphas_cumprod_prev',
+        'sqrt_alphas_cumprod', 'sqrt_one_minus_alphas_cumprod', 'log_one_minus_alphas_cumprod',
+        'sqrt_recip_alphas_cumprod', 'sqrt_recipm1_alphas_cumprod',
+        'ddim_sigmas', 'ddim_alphas', 'ddim_alphas_prev', 'ddim_sqrt_one_minus_alphas',
+        'ddim_sigmas_for_original_num_steps', ]
+
     def __init__(self, model, schedule="linear", **kwargs):
         super().__init__()
         self.model = model
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
+        self.schedules = {}
+
+    @property
+    def device(self):
+        # Scripts move the diffusion model rather than the whole model, whose
+        # device attribute then stays 'cpu', so follow its parameters
+        diffusion_model = getattr(getattr(self.model, 'model', None), 'diffusion_model', None)
+        if diffusion_model is not None:
+            for p in diffusion_model.parameters():
+                return p.device
+        return torch.device(self.model.device)
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            if attr.device != self.device:
+                attr = attr.to(self.device)
         setattr(self, name, attr)
 
+    def schedule_key(self, ddim_num_steps, ddim_discretize, ddim_eta):
+        alphas_cumprod = self.model.alphas_cumprod
+        return (ddim_num_steps, float(ddim_eta), ddim_discretize,
+                str(self.device), str(alphas_cumprod.device), alphas_cumprod.dtype)
+
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        # Schedules are memoised, sampling many images only computes them once
+        key = self.schedule_key(ddim_num_steps, ddim_discretize, ddim_eta)
+        if key in self.schedules:
+            for name, attr in self.schedules[key].items():
+                setattr(self, name, attr)
+            return
+
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, 
                                                   num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,
                                                   verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
         assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
-        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
+        to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.device)
 
         self.register_buffer('betas', to_torch(self.model.betas))
         self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
@@ -49,12 +79,13 @@ class DDIMSampler(object):
 
         self.register_buffer('ddim_sigmas', ddim_sigmas)
         self.register_buffer('ddim_alphas', ddim_alphas)
-        self.register_buffer('ddim_alphas_prev', ddim_alphas_prev)
+        self.register_buffer('ddim_alphas_prev', torch.as_tensor(ddim_alphas_prev, dtype=ddim_alphas.dtype))
         self.register_buffer('ddim_sqrt_one_minus_alphas', np.sqrt(1. - ddim_alphas))
         sigmas_for_original_sampling_steps = ddim_eta * torch.sqrt(
             (1 - self.alphas_cumprod_prev) / (1 - self.alphas_cumprod) * (
                         1 - self.alphas_cumprod / self.alphas_cumprod_prev))
         self.register_buffer('ddim_sigmas_for_original_num_steps', sigmas_for_original_sampling_steps)
+        self.schedules[key] = {name: getattr(self, name) for name in self.schedule_buffers}
 
     @torch.no_grad()
     def sample(self,
@@ -15,6 +15,7 @@ class DDIMSampler_DualModel(DDIMSampler):
         self.device = self.model_t2i.device
         self.ddpm_num_timesteps = model_t2i.num_timesteps
         self.schedule = schedule
+        self.schedules = {}
 
     @torch.no_grad()
     def sample_text(self, *args, **kwargs):
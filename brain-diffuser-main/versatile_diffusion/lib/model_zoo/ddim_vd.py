@@ -6,6 +6,7 @@ from functools import partial
 from .diffusion_utils import make_ddim_sampling_parameters, make_ddim_timesteps, noise_like
 
 from .ddim import DDIMSampler
+from .attention import cache_context_kv
 
 class DDIMSampler_VD(DDIMSampler):
     @torch.no_grad()
@@ -71,26 +72,37 @@ class DDIMSampler_VD(DDIMSampler):
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         # print(f"Running DDIM Sampling with {total_steps} timesteps")
 
+        # The guided context is concatenated (and cast to the model precision)
+        # once, so the cross-attention keys/values computed on the first step
+        # are reused on the others
+        dtype = self.model.model.diffusion_model.dtype
+        conditioning = conditioning.to(dtype)
+        guided_conditioning = None
+        if unconditional_conditioning is not None and unconditional_guidance_scale != 1.:
+            guided_conditioning = torch.cat([unconditional_conditioning.to(dtype), conditioning])
+
         pred_xt = xt
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((bs,), step, device=device, dtype=torch.long)
-
-            outs = self.p_sample_ddim(
-                pred_xt, conditioning, ts, index, 
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                unconditional_conditioning=unconditional_conditioning, 
-                xtype=xtype,
-                ctype=ctype,
-                use_original_steps=ddim_use_original_steps,
-                noise_dropout=noise_dropout,
-                temperature=temperature,)
-            pred_xt, pred_x0 = outs
-
-            if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['pred_xt'].append(pred_xt)
-                intermediates['pred_x0'].append(pred_x0)
+        with cache_context_kv(self.model.model.diffusion_model):
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((bs,), step, device=device, dtype=torch.long)
+
+                outs = self.p_sample_ddim(
+                    pred_xt, conditioning, ts, index, 
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    unconditional_conditioning=unconditional_conditioning, 
+                    xtype=xtype,
+                    ctype=ctype,
+                    use_original_steps=ddim_use_original_steps,
+                    noise_dropout=noise_dropout,
+                    temperature=temperature,
+                    guided_conditioning=guided_conditioning,)
+                pred_xt, pred_x0 = outs
+
+                if index % log_every_t == 0 or index == total_steps - 1:
+                    intermediates['pred_xt'].append(pred_xt)
+                    intermediates['pred_x0'].append(pred_x0)
 
         return pred_xt, intermediates
 
@@ -103,7 +115,8 @@ class DDIMSampler_VD(DDIMSampler):
                       repeat_noise=False, 
                       use_original_steps=False, 
                       noise_dropout=0.,
-                      temperature=1.,):
+                      temperature=1.,
+                      guided_conditioning=None,):
 
         b, *_, device = *x.shape, self.model.model.diffusion_model.device
 
@@ -112,7 +125,9 @@ class DDIMSampler_VD(DDIMSampler):
         else:
             x_in = torch.cat([x] * 2)
             t_in = torch.cat([t] * 2)
-            c_in = torch.cat([unconditional_conditioning, conditioning])
+            # guided_conditioning is the concatenation below, precomputed by the caller
+            c_in = guided_conditioning if guided_conditioning is not None else \
+                torch.cat([unconditional_conditioning, conditioning])
             e_t_uncond, e_t = self.model.apply_model(x_in, t_in, c_in, xtype=xtype, ctype=ctype).chunk(2)
             e_t = e_t_uncond + unconditional_guidance_scale * (e_t - e_t_uncond)
 
@@ -127,10 +142,11 @@ class DDIMSampler_VD(DDIMSampler):
         elif xtype == 'text':
             extended_shape = (b, 1)
 
-        a_t = torch.full(extended_shape, alphas[index], device=device, dtype=x.dtype)
-        a_prev = torch.full(extended_shape, alphas_prev[index], device=device, dtype=x.dtype)
-        sigma_t = torch.full(extended_shape, sigmas[index], device=device, dtype=x.dtype)
-        sqrt_one_minus_at = torch.full(extended_shape, sqrt_one_minus_alphas[index], device=device, dtype=x.dtype)
+        # Indexed on the schedule's device, torch.full would read each value back to the host
+        a_t = alphas[index].to(device, x.dtype).expand(extended_shape)
+        a_prev = alphas_prev[index].to(device, x.dtype).expand(extended_shape)
+        sigma_t = sigmas[index].to(device, x.dtype).expand(extended_shape)
+        sqrt_one_minus_at = sqrt_one_minus_alphas[index].to(device, x.dtype).expand(extended_shape)
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
@@ -210,30 +226,38 @@ class DDIMSampler_VD(DDIMSampler):
         total_steps = timesteps if ddim_use_original_steps else timesteps.shape[0]
         # print(f"Running DDIM Sampling with {total_steps} timesteps")
 
+        # Contexts are concatenated (and cast to the model precision) once, so
+        # the cross-attention keys/values computed on the first step are
+        # reused on the others
+        dtype = self.model.model.diffusion_model.dtype
+        first_conditioning = torch.cat(first_conditioning).to(dtype)
+        second_conditioning = torch.cat(second_conditioning).to(dtype)
+
         pred_xt = xt
         iterator = tqdm(time_range, desc='DDIM Sampler', total=total_steps)
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((bs,), step, device=device, dtype=torch.long)
-
-            outs = self.p_sample_ddim_dc(
-                pred_xt, 
-                first_conditioning, 
-                second_conditioning, 
-                ts, index, 
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                xtype=xtype,
-                first_ctype=first_ctype,
-                second_ctype=second_ctype,
-                use_original_steps=ddim_use_original_steps,
-                noise_dropout=noise_dropout,
-                temperature=temperature,
-                mixed_ratio=mixed_ratio,)
-            pred_xt, pred_x0 = outs
-
-            if index % log_every_t == 0 or index == total_steps - 1:
-                intermediates['pred_xt'].append(pred_xt)
-                intermediates['pred_x0'].append(pred_x0)
+        with cache_context_kv(self.model.model.diffusion_model):
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((bs,), step, device=device, dtype=torch.long)
+
+                outs = self.p_sample_ddim_dc(
+                    pred_xt, 
+                    first_conditioning, 
+                    second_conditioning, 
+                    ts, index, 
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    xtype=xtype,
+                    first_ctype=first_ctype,
+                    second_ctype=second_ctype,
+                    use_original_steps=ddim_use_original_steps,
+                    noise_dropout=noise_dropout,
+                    temperature=temperature,
+                    mixed_ratio=mixed_ratio,)
+                pred_xt, pred_x0 = outs
+
+                if index % log_every_t == 0 or index == total_steps - 1:
+                    intermediates['pred_xt'].append(pred_xt)
+                    intermediates['pred_x0'].append(pred_x0)
 
         return pred_xt, intermediates
 
@@ -256,8 +280,9 @@ class DDIMSampler_VD(DDIMSampler):
 
         x_in = torch.cat([x] * 2)
         t_in = torch.cat([t] * 2)
-        first_c = torch.cat(first_conditioning)
-        second_c = torch.cat(second_conditioning)
+        # Conditionings are [unconditional, conditional] lists or their concatenation
+        first_c = torch.cat(first_conditioning) if isinstance(first_conditioning, (list, tuple)) else first_conditioning
+        second_c = torch.cat(second_conditioning) if isinstance(second_conditioning, (list, tuple)) else second_conditioning
 
         e_t_uncond, e_t = self.model.apply_model_dc(
             x_in, t_in, first_c, second_c, xtype=xtype, first_ctype=first_ctype, second_ctype=second_ctype, mixed_ratio=mixed_ratio).chunk(2)
@@ -275,10 +300,11 @@ class DDIMSampler_VD(DDIMSampler):
         elif xtype == 'text':
             extended_shape = (b, 1)
 
-        a_t = torch.full(extended_shape, alphas[index], device=device, dtype=x.dtype)
-        a_prev = torch.full(extended_shape, alphas_prev[index], device=device, dtype=x.dtype)
-        sigma_t = torch.full(extended_shape, sigmas[index], device=device, dtype=x.dtype)
-        sqrt_one_minus_at = torch.full(extended_shape, sqrt_one_minus_alphas[index], device=device, dtype=x.dtype)
+        # Indexed on the schedule's device, torch.full would read each value back to the host
+        a_t = alphas[index].to(device, x.dtype).expand(extended_shape)
+        a_prev = alphas_prev[index].to(device, x.dtype).expand(extended_shape)
+        sigma_t = sigmas[index].to(device, x.dtype).expand(extended_shape)
+        sqrt_one_minus_at = sqrt_one_minus_alphas[index].to(device, x.dtype).expand(extended_shape)
 
         # current prediction for x_0
         pred_x0 = (x - sqrt_one_minus_at * e_t) / a_t.sqrt()
@@ -302,7 +328,7 @@ class DDIMSampler_VD(DDIMSampler):
            alphas = self.alphas_cumprod_prev[:num_steps]
        else:
            alphas_next = self.ddim_alphas[:num_steps]
-           alphas = torch.tensor(self.ddim_alphas_prev[:num_steps])
+           alphas = self.ddim_alphas_prev[:num_steps]
        
        alphas_next = alphas_next.to(x0.device)
        alphas = alphas.to(x0.device)
@@ -350,8 +376,9 @@ class DDIMSampler_VD(DDIMSampler):
             sqrt_alphas_cumprod = torch.sqrt(self.ddim_alphas)
             sqrt_one_minus_alphas_cumprod = self.ddim_sqrt_one_minus_alphas
             
-        sqrt_alphas_cumprod = sqrt_alphas_cumprod.to(t.device)
-        sqrt_one_minus_alphas_cumprod = sqrt_one_minus_alphas_cumprod.to(t.device)
+        # In the latent dtype, so half precision latents are not upcast
+        sqrt_alphas_cumprod = sqrt_alphas_cumprod.to(t.device, x0.dtype)
+        sqrt_one_minus_alphas_cumprod = sqrt_one_minus_alphas_cumprod.to(t.device, x0.dtype)
 
         if noise is None:
             noise = torch.randn_like(x0)
@@ -393,23 +420,30 @@ class DDIMSampler_VD(DDIMSampler):
 
         iterator = tqdm(time_range, desc='Decoding image', total=total_steps)
         x_dec = x_latent
-        for i, step in enumerate(iterator):
-            index = total_steps - i - 1
-            ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
-            x_dec, _ = self.p_sample_ddim_dc(
-                x_dec, 
-                first_conditioning, 
-                second_conditioning, 
-                ts, index, 
-                unconditional_guidance_scale=unconditional_guidance_scale,
-                xtype=xtype,
-                first_ctype=first_ctype,
-                second_ctype=second_ctype,
-                use_original_steps=use_original_steps,
-                noise_dropout=0,
-                temperature=1,
-                mixed_ratio=mixed_ratio,)
-            if callback: callback(i)
+        # Contexts are concatenated (and cast to the model precision) once, so
+        # the cross-attention keys/values computed on the first step are
+        # reused on the others
+        dtype = self.model.model.diffusion_model.dtype
+        first_conditioning = torch.cat(first_conditioning).to(dtype)
+        second_conditioning = torch.cat(second_conditioning).to(dtype)
+        with cache_context_kv(self.model.model.diffusion_model):
+            for i, step in enumerate(iterator):
+                index = total_steps - i - 1
+                ts = torch.full((x_latent.shape[0],), step, device=x_latent.device, dtype=torch.long)
+                x_dec, _ = self.p_sample_ddim_dc(
+                    x_dec, 
+                    first_conditioning, 
+                    second_conditioning, 
+                    ts, index, 
+                    unconditional_guidance_scale=unconditional_guidance_scale,
+                    xtype=xtype,
+                    first_ctype=first_ctype,
+                    second_ctype=second_ctype,
+                    use_original_steps=use_original_steps,
+                    noise_dropout=0,
+                    temperature=1,
+                    mixed_ratio=mixed_ratio,)
+                if callback: callback(i)
         return x_dec
     
     
@@ -6,7 +6,7 @@ import numpy as np
 from einops import rearrange
 
 # from .diffusion_utils import instantiate_from_config
-from .attention import LinearAttention
+from .attention import LinearAttention, attention
 
 
 def get_timestep_embedding(timesteps, embedding_dim):
@@ -173,6 +173,7 @@ class AttnBlock(nn.Module):
                                         kernel_size=1,
                                         stride=1,
                                         padding=0)
+        self.attention_backend = 'einsum'
 
 
     def forward(self, x):
@@ -184,6 +185,12 @@ class AttnBlock(nn.Module):
 
         # compute attention
         b,c,h,w = q.shape
+        if self.attention_backend != 'einsum':
+            q, k, v = map(lambda t: t.reshape(b,c,h*w).permute(0,2,1), (q, k, v))  # b,hw,c
+            h_ = attention(q, k, v, int(c)**(-0.5), self.attention_backend)
+            h_ = h_.permute(0,2,1).reshape(b,c,h,w)
+            return x+self.proj_out(h_)
+
         q = q.reshape(b,c,h*w)
         q = q.permute(0,2,1)   # b,hw,c
         k = k.reshape(b,c,h*w) # b,c,hw
@@ -2344,12 +2344,20 @@ class UNetModel0D_MultiDim(nn.Module):
                  second_dim=(4, 4, 4, 4),
                  with_attn=[True, True, True, False],
                  num_heads=8,
-                 use_checkpoint=True, ):
+                 use_checkpoint=True,
+                 context_only=False, ):
 
         super().__init__()
 
         FCBlockPreset = partial(FCBlock_MultiDim, dropout=0, use_checkpoint=use_checkpoint)
+        LinearPreset = Linear_MultiDim
+        if context_only:
+            # Only the SpatialTransformers are built, which is all UNetModelVD uses 
+            # of this model for image outputs. Identity placeholders keep the layers 
+            # aligned with the image UNet and the checkpoint keys of the transformers.
+            FCBlockPreset = LinearPreset = lambda *args, **kwargs: nn.Identity()
  
+        self.context_only = context_only
         self.input_channels = input_channels
         self.model_channels = model_channels
         self.num_noattn_blocks = num_noattn_blocks
@@ -2374,7 +2382,7 @@ class UNetModel0D_MultiDim(nn.Module):
         current_channel = [model_channels, sdim, 1]
         input_blocks = [
             TimestepEmbedSequential(
-                Linear_MultiDim([input_channels, 1, 1], current_channel, bias=True))]
+                LinearPreset([input_channels, 1, 1], current_channel, bias=True))]
         input_block_channels = [current_channel]
 
         for level_idx, (mult, sdim) in enumerate(zip(channel_mult, second_dim)):
@@ -2399,7 +2407,7 @@ class UNetModel0D_MultiDim(nn.Module):
             if level_idx != len(channel_mult) - 1:
                 input_blocks += [
                     TimestepEmbedSequential(
-                        Linear_MultiDim(current_channel, current_channel, bias=True, ))]
+                        LinearPreset(current_channel, current_channel, bias=True, ))]
                 input_block_channels.append(current_channel)
 
         self.input_blocks = nn.ModuleList(input_blocks)
@@ -2440,7 +2448,7 @@ class UNetModel0D_MultiDim(nn.Module):
 
                 if level_idx!=0 and block_idx==self.num_noattn_blocks[level_idx]:
                     layers += [
-                        Linear_MultiDim(current_channel, current_channel, bias=True, )]
+                        LinearPreset(current_channel, current_channel, bias=True, )]
 
                 output_blocks += [TimestepEmbedSequential(*layers)]
 
@@ -2449,7 +2457,7 @@ class UNetModel0D_MultiDim(nn.Module):
         self.out = nn.Sequential(
             normalization(current_channel[0]),
             nn.SiLU(),
-            zero_module(Linear_MultiDim(current_channel, [output_channels, 1, 1], bias=True, )),)
+            zero_module(LinearPreset(current_channel, [output_channels, 1, 1], bias=True, )),)
 
     def forward(self, x, timesteps=None, context=None):
         hs = []
@@ -2480,14 +2488,21 @@ class UNetModelVD(nn.Module):
         del self.unet_text.time_embed
 
         self.model_channels = self.unet_image.model_channels
-        
+
+    @property
+    def dtype(self):
+        """Precision of the weights, inputs are cast to it (see VD.set_precision)."""
+        return self.time_embed[0].weight.dtype
+
     def forward(self, x, timesteps, context, xtype='image', ctype='prompt'):
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        x=x.to(self.device).half()#.float()#.half()
-        emb = self.time_embed(t_emb.to(self.device).half())#.float()#.half())
+        x = x.to(self.device, self.dtype)
+        emb = self.time_embed(t_emb.to(self.device, self.dtype))
+        context = context.to(self.dtype)
 
         if xtype == 'text':
+            assert not getattr(self.unet_text, 'context_only', False), 'unet_text was built without its text layers'
             x = x[:, :, None, None]
 
         h = x
@@ -2528,10 +2543,13 @@ class UNetModelVD(nn.Module):
     def forward_dc(self, x, timesteps, c0, c1, xtype, c0_type, c1_type, mixed_ratio):
         hs = []
         t_emb = timestep_embedding(timesteps, self.model_channels, repeat_only=False)
-        x=x.to(self.device).half()
-        emb = self.time_embed(t_emb.to(self.device).half())
+        x = x.to(self.device, self.dtype)
+        emb = self.time_embed(t_emb.to(self.device, self.dtype))
+        # No-ops when the sampler already passes contexts in this dtype, which keeps their cross-attention keys/values cached
+        c0, c1 = c0.to(self.dtype), c1.to(self.dtype)
 
         if xtype == 'text':
+            assert not getattr(self.unet_text, 'context_only', False), 'unet_text was built without its text layers'
             x = x[:, :, None, None]
         h = x
         for i_module, t_module in zip(self.unet_image.input_blocks, self.unet_text.input_blocks):
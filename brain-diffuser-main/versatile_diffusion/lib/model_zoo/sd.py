@@ -59,10 +59,15 @@ class DDPM(nn.Module):
         self.use_positional_encodings = use_positional_encodings
 
         from collections import OrderedDict
-        self.model = nn.Sequential(OrderedDict([('diffusion_model', get_model()(unet_config))]))
+        # A null unet_config builds the model without a diffusion model (e.g. for CLIP feature extraction)
+        self.model = None
+        if unet_config is not None:
+            self.model = nn.Sequential(OrderedDict([('diffusion_model', get_model()(unet_config))]))
         # TODO: Remove this ugly trick to match SD with deprecated version, after no bug with the module.
 
         self.use_ema = use_ema
+        if self.use_ema and self.model is None:
+            raise ValueError('use_ema needs a diffusion model, unet_config is null')
         if self.use_ema:
             self.model_ema = LitEma(self.model)
             print_log(f"Keeping EMAs of {len(list(self.model_ema.buffers()))}.")
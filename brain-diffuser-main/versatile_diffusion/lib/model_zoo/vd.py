@@ -4,8 +4,9 @@ import torch.nn.functional as F
 import numpy as np
 import numpy.random as npr
 import copy
+import inspect
 from functools import partial
-from contextlib import contextmanager
+from contextlib import contextmanager, nullcontext
 from lib.model_zoo.common.get_model import get_model, register
 from lib.log_service import print_log
 
@@ -17,6 +18,7 @@ from .diffusion_utils import \
 from .distributions import normal_kl, DiagonalGaussianDistribution
 
 from .autoencoder import AutoencoderKL
+from .attention import set_attention_backend
 from .ema import LitEma
 
 from .sd import highlight_print, DDPM, SD_T2I
@@ -214,14 +216,21 @@ class VD(DDPM):
                  clip_cfg,
                  scale_factor=1.0,
                  scale_by_std=False,
+                 attention_backend='einsum',
+                 precision='float32',
+                 autocast=False,
+                 clip_precision='float32',
                  *args, 
                  **kwargs):
         self.scale_by_std = scale_by_std
         super().__init__(*args, **kwargs)
 
-        self.autokl = get_model()(autokl_cfg)
-        self.optimus = get_model()(optimus_cfg)
-        self.clip = get_model()(clip_cfg)
+        # Components with a null config are not built (see vd_noema_image, vd_noema_clip)
+        self.autokl = get_model()(autokl_cfg) if autokl_cfg is not None else None
+        self.optimus = get_model()(optimus_cfg) if optimus_cfg is not None else None
+        self.clip = get_model()(clip_cfg) if clip_cfg is not None else None
+        # Attention implementation of the UNet and autoencoder (see attention.ATTENTION_BACKENDS)
+        set_attention_backend(self, attention_backend)
 
         self.concat_mode = 'crossattn'
         if not scale_by_std:
@@ -230,6 +239,37 @@ class VD(DDPM):
             self.register_buffer('scale_factor', torch.tensor(scale_factor))
         self.device = 'cpu'
         self.parameter_group = self.create_parameter_group()
+        self.null_embeddings = {}
+        self.set_precision(precision, autocast, clip_precision)
+
+    def set_precision(self, precision='float32', autocast=False, clip_precision='float32'):
+        """
+        Precision policy of the diffusion model and autokl: 'float32',
+        'bfloat16' or 'float16'. Their weights are cast to it, or with
+        autocast kept in float32 while their forward passes run under
+        torch.autocast in that precision. CLIP follows clip_precision the
+        same way, which defaults to float32 so the conditioning embeddings
+        do not change with the precision of the other models. Inputs are
+        cast by the models, so callers can pass float32 tensors.
+        """
+        for p in [precision, clip_precision]:
+            assert p in ['float32', 'bfloat16', 'float16'], f'precision {p} unknown'
+        dtype, clip_dtype = getattr(torch, precision), getattr(torch, clip_precision)
+        self.precision, self.autocast, self.clip_precision = precision, autocast, clip_precision
+        self.autocast_dtype = dtype if autocast and dtype != torch.float32 else None
+        self.clip_autocast_dtype = clip_dtype if autocast and clip_dtype != torch.float32 else None
+        for module in [m for m in [self.model, self.autokl] if m is not None]:
+            module.to(torch.float32 if self.autocast_dtype is not None else dtype)
+        if self.clip is not None:
+            self.clip.to(torch.float32 if self.clip_autocast_dtype is not None else clip_dtype)
+        self.null_embeddings = {}
+
+    def precision_scope(self, module):
+        """torch.autocast context for running module under the precision policy."""
+        autocast_dtype = self.clip_autocast_dtype if module is self.clip else self.autocast_dtype
+        if autocast_dtype is None:
+            return nullcontext()
+        return torch.autocast(next(module.parameters()).device.type, dtype=autocast_dtype)
 
     def create_parameter_group(self):
         def is_part_of_unet_image(name):
@@ -256,6 +296,8 @@ class VD(DDPM):
             'text_trans'  : [],
             'text_rest'   : [],
             'rest'        : [],}
+        if self.model is None:
+            return parameter_group
         for pname, para in self.model.named_parameters():
             if is_part_of_unet_image(pname):
                 if is_part_of_trans(pname):
@@ -274,8 +316,35 @@ class VD(DDPM):
 
     def to(self, device):
         self.device = device
+        self.null_embeddings = {}
         super().to(device)
 
+    def load_state_dict(self, *args, **kwargs):
+        self.null_embeddings = {}
+        return super().load_state_dict(*args, **kwargs)
+
+    def load_checkpoint(self, pth):
+        """
+        Loads a VD checkpoint into the components this model was built with.
+        Weights of components left out (e.g. optimus in vd_noema_image) are 
+        dropped before loading, and with torch >= 2.1 the checkpoint is 
+        memory-mapped so they are never read from disk.
+        """
+        if 'mmap' in inspect.signature(torch.load).parameters:
+            try:
+                sd = torch.load(pth, map_location='cpu', mmap=True)
+            except RuntimeError:
+                # Checkpoints in the legacy (non zip) format cannot be memory-mapped
+                sd = torch.load(pth, map_location='cpu')
+        else:
+            sd = torch.load(pth, map_location='cpu')
+        own = self.state_dict()
+        skipped = [k for k in sd if k not in own]
+        sd = {k: v for k, v in sd.items() if k in own}
+        print_log('Loading {} tensors from {}, skipping {} of components not built.'.format(
+            len(sd), pth, len(skipped)))
+        return self.load_state_dict(sd, strict=False)
+
     @torch.no_grad()
     def on_train_batch_start(self, x):
         # only for very first batch
@@ -290,15 +359,19 @@ class VD(DDPM):
             highlight_print("setting self.scale_factor to {}".format(self.scale_factor))
 
     @torch.no_grad()
-    def autokl_encode(self, image):
-        encoder_posterior = self.autokl.encode(image)
-        z = encoder_posterior.sample()
+    def autokl_encode(self, image, noise=None):
+        image = image.to(next(self.autokl.parameters()).dtype)
+        with self.precision_scope(self.autokl):
+            encoder_posterior = self.autokl.encode(image)
+        z = encoder_posterior.sample(noise)
         return self.scale_factor * z
 
     @torch.no_grad()
     def autokl_decode(self, z):
         z = 1. / self.scale_factor * z
-        return self.autokl.decode(z)
+        z = z.to(next(self.autokl.parameters()).dtype)
+        with self.precision_scope(self.autokl):
+            return self.autokl.decode(z)
 
     def mask_tokens(inputs, tokenizer, args):
         labels = inputs.clone()
@@ -362,7 +435,8 @@ class VD(DDPM):
     def clip_encode_text(self, text, encode_type='encode_text'):
         swap_type = self.clip.encode_type
         self.clip.encode_type = encode_type
-        embedding = self.clip.encode(text)
+        with self.precision_scope(self.clip):
+            embedding = self.clip.encode(text)
         self.clip.encode_type = swap_type
         return embedding
 
@@ -371,19 +445,38 @@ class VD(DDPM):
         swap_type = self.clip.encode_type
         self.clip.encode_type = encode_type
         if isinstance(vision, torch.Tensor):
-            vision = ((vision+1)/2).to('cpu').numpy()
+            vision = ((vision+1)/2).to('cpu').float().numpy()
             vision = np.transpose(vision, (0, 2, 3, 1))
             vision = [vi for vi in vision]
-        embedding = self.clip.encode(vision)
+        with self.precision_scope(self.clip):
+            embedding = self.clip.encode(vision)
         self.clip.encode_type = swap_type
         return embedding
 
+    @torch.no_grad()
+    def clip_encode_null(self, ctype):
+        """
+        Unconditional embedding used for classifier-free guidance: the CLIP
+        embedding of an empty prompt (ctype 'prompt') or of a blank image
+        ('vision'). It is cached until the weights are reloaded or moved.
+        """
+        if ctype not in self.null_embeddings:
+            if ctype == 'prompt':
+                embedding = self.clip_encode_text('')
+            elif ctype == 'vision':
+                embedding = self.clip_encode_vision(torch.zeros((1, 3, 224, 224)))
+            else:
+                raise NotImplementedError("unknown ctype '{}'".format(ctype))
+            self.null_embeddings[ctype] = embedding
+        return self.null_embeddings[ctype]
+
     def forward(self, x, c, noise=None, xtype='image', ctype='prompt'):
         t = torch.randint(0, self.num_timesteps, (x.shape[0],), device=x.device).long()
         return self.p_losses(x, c, t, noise, xtype, ctype)
 
     def apply_model(self, x_noisy, t, cond, xtype='image', ctype='prompt'):
-        return self.model.diffusion_model(x_noisy, t, cond, xtype, ctype)
+        with self.precision_scope(self.model):
+            return self.model.diffusion_model(x_noisy, t, cond, xtype, ctype)
 
     def get_image_loss(self, pred, target, mean=True):
         if self.loss_type == 'l1':
@@ -439,4 +532,5 @@ class VD(DDPM):
         return loss, loss_dict
 
     def apply_model_dc(self, x_noisy, t, first_c, second_c, xtype='image', first_ctype='vision', second_ctype='prompt', mixed_ratio=0.5):
-        return self.model.diffusion_model.forward_dc(x_noisy, t, first_c, second_c, xtype, first_ctype, second_ctype, mixed_ratio)
\ No newline at end of file
+        with self.precision_scope(self.model):
+            return self.model.diffusion_model.forward_dc(x_noisy, t, first_c, second_c, xtype, first_ctype, second_ctype, mixed_ratio)
\ No newline at end of file
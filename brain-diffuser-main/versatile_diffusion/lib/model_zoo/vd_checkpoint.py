@@ -0,0 +1,160 @@
+import os
+import copy
+import json
+import inspect
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.nn as nn
+from lib.model_zoo.common.get_model import get_model
+from lib.log_service import print_log
+
+CHECKPOINT_HEADER = 'header.json'
+CHECKPOINT_FORMAT_VERSION = 1
+CHECKPOINT_DTYPES = ['float16', 'float32', 'float64', 'int64', 'int32', 'bool']
+
+def sharded_checkpoint_path(pth):
+    """Directory of the sharded checkpoint converted from the torch checkpoint at pth."""
+    return os.path.splitext(pth)[0] + '-sharded'
+
+def checkpoint_shard(name):
+    """
+    Shard of a VD state dict entry: its component (autokl, optimus, clip,
+    model), with the image and text UNets of the diffusion model in shards
+    of their own. Schedule buffers of the VD itself go to 'vd'.
+    """
+    parts = name.split('.')
+    if parts[:2] == ['model', 'diffusion_model'] and parts[2] in ['unet_image', 'unet_text']:
+        return parts[2]
+    return parts[0] if len(parts) > 1 else 'vd'
+
+def save_sharded_checkpoint(state_dict, out_dir):
+    """
+    Writes the tensors of state_dict as flat .npy arrays, one per shard and
+    dtype, plus a JSON index of their files, shapes and offsets, so the
+    weights can be memory-mapped at load time. Tensors keep their dtype.
+    """
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    tensors, sizes = {}, {}
+    for name, tensor in state_dict.items():
+        tdtype = str(tensor.dtype).split('.')[-1]
+        assert tdtype in CHECKPOINT_DTYPES, 'Unsupported checkpoint dtype {} of {}'.format(tdtype, name)
+        fname = '{}-{}.npy'.format(checkpoint_shard(name), tdtype)
+        offset = sizes.get(fname, 0)
+        tensors[name] = {'file': fname, 'dtype': tdtype, 'shape': list(tensor.shape), 'offset': offset}
+        sizes[fname] = offset + tensor.numel()
+    for fname, size in sizes.items():
+        entries = {n: info for n, info in tensors.items() if info['file'] == fname}
+        fdtype = next(iter(entries.values()))['dtype']
+        flat = np.lib.format.open_memmap(os.path.join(out_dir, fname), mode='w+', dtype=fdtype, shape=(size,))
+        for name, info in entries.items():
+            tensor = state_dict[name].detach().cpu()
+            flat[info['offset']:info['offset'] + tensor.numel()] = tensor.numpy().ravel()
+        flat.flush()
+        del flat
+    with open(os.path.join(out_dir, CHECKPOINT_HEADER), 'w') as f:
+        json.dump({'format_version': CHECKPOINT_FORMAT_VERSION, 'tensors': tensors}, f, indent=2)
+
+def load_sharded_state_dict(path, names=None):
+    """
+    State dict of tensors viewing the memory-mapped sharded checkpoint at
+    path, restricted to names when given. Only the shards holding them are
+    opened, the mapping is copy-on-write and pages are only read when used.
+    """
+    with open(os.path.join(path, CHECKPOINT_HEADER), 'r') as f:
+        header = json.load(f)
+    assert header['format_version'] == CHECKPOINT_FORMAT_VERSION, \
+        'Unsupported checkpoint format {}'.format(header['format_version'])
+    tensors = header['tensors']
+    if names is not None:
+        tensors = {n: tensors[n] for n in names if n in tensors}
+    shards, state_dict = {}, {}
+    for name, info in tensors.items():
+        if info['file'] not in shards:
+            shards[info['file']] = torch.from_numpy(np.load(os.path.join(path, info['file']), mmap_mode='c'))
+        numel = int(np.prod(info['shape']))
+        state_dict[name] = shards[info['file']][info['offset']:info['offset'] + numel].view(info['shape'])
+    return state_dict
+
+_empty_init = threading.local()
+_empty_init_lock = threading.Lock()
+_empty_init_users = 0
+_register_parameter = nn.Module.register_parameter
+
+def _register_parameter_on_meta(module, name, param):
+    # Only threads inside init_empty_parameters get meta parameters
+    if getattr(_empty_init, 'depth', 0) > 0 and param is not None and param.device.type != 'meta':
+        param = nn.Parameter(param.to('meta'), requires_grad=param.requires_grad)
+    _register_parameter(module, name, param)
+
+@contextmanager
+def init_empty_parameters():
+    """
+    Modules built in this context by the calling thread get their
+    parameters on the meta device, so no weights are kept. Buffers and
+    other tensors are created as usual (a torch.device('meta') context
+    would put those on meta too, and they are not all in the checkpoint).
+    Modules built by other threads meanwhile are not affected, and
+    nn.Module.register_parameter is restored once the last user leaves,
+    also when building raises.
+    """
+    global _empty_init_users
+    with _empty_init_lock:
+        if _empty_init_users == 0:
+            nn.Module.register_parameter = _register_parameter_on_meta
+        _empty_init_users += 1
+    _empty_init.depth = getattr(_empty_init, 'depth', 0) + 1
+    try:
+        yield
+    finally:
+        _empty_init.depth -= 1
+        with _empty_init_lock:
+            _empty_init_users -= 1
+            if _empty_init_users == 0:
+                nn.Module.register_parameter = _register_parameter
+
+def without_pretrained(cfg):
+    """Copy of a model cfg without the pth/ckpt of its sub-models, whose weights a full checkpoint holds."""
+    if isinstance(cfg, dict):
+        return cfg.__class__({k: without_pretrained(v) for k, v in cfg.items() if k not in ['pth', 'ckpt']})
+    if isinstance(cfg, list):
+        return [without_pretrained(v) for v in cfg]
+    return copy.deepcopy(cfg)
+
+def load_vd_model(cfg, pth):
+    """
+    Builds the VD model of cfg and loads the checkpoint pth. If pth was
+    converted with scripts/convert_vd_checkpoint.py the sharded checkpoint
+    is used: where torch supports it (>= 2.1) the parameters are created on
+    the meta device and the mapped tensors assigned to them, so no weights
+    are allocated, initialised and then overwritten; older versions build
+    normally and copy them in. Otherwise falls back to VD.load_checkpoint.
+    """
+    path = sharded_checkpoint_path(pth)
+    if not os.path.isdir(path):
+        net = get_model()(cfg)
+        net.load_checkpoint(pth)
+        return net
+
+    cfg = without_pretrained(cfg)
+    assign = 'assign' in inspect.signature(nn.Module.load_state_dict).parameters
+    if assign:
+        with init_empty_parameters():
+            net = get_model()(cfg)
+    else:
+        net = get_model()(cfg)
+    names = list(net.state_dict().keys())
+    state_dict = load_sharded_state_dict(path, names)
+    missing = [n for n in names if n not in state_dict]
+    assert len(missing) == 0, 'Sharded checkpoint {} lacks {} tensors, e.g. {}'.format(path, len(missing), missing[:3])
+    print_log('Mapping {} tensors from {}.'.format(len(state_dict), path))
+    if assign:
+        net.load_state_dict(state_dict, assign=True)
+        # Assigned tensors keep their stored dtype, restore the precision policy
+        net.set_precision(net.precision, net.autocast, net.clip_precision)
+    else:
+        net.load_state_dict(state_dict)
+    return net
@@ -28,7 +28,8 @@ def is_ddp():
 def get_rank(type='local'):
     ddp = is_ddp()
     global_rank = dist.get_rank() if ddp else 0
-    local_world_size = torch.cuda.device_count()
+    # One local process on machines without GPUs
+    local_world_size = max(torch.cuda.device_count(), 1)
     if type == 'global':
         return global_rank
     elif type == 'local':
@@ -46,7 +47,8 @@ def get_world_size(type='local'):
     ddp = is_ddp()
     global_rank = dist.get_rank() if ddp else 0
     global_world_size = dist.get_world_size() if ddp else 1
-    local_world_size = torch.cuda.device_count()
+    # One local process on machines without GPUs
+    local_world_size = max(torch.cuda.device_count(), 1)
     if type == 'global':
         return global_world_size
     elif type == 'local':